@@ -360,7 +360,8 @@ class MetricsCollector(object):
                                                     'section': plugin.name},
                                               values={'queue_length': plugin.get_queue_length()},
                                               timestamp=now)
-                    for key in set(self._metrics_controller.inbound_rates.keys()) | set(self._metrics_controller.outbound_rates.keys()):
+                    # Every outbound rate key is also an inbound rate key, so the (cached) inbound keys cover both
+                    for key in list(self._metrics_controller.rate_keys):
                         self._enqueue_metrics(metric_type=metric_type,
                                               tags={'name': 'gateway',
                                                     'section': key},
@@ -21,13 +21,18 @@ import time
 import logging
 import requests
 import ujson as json
-from threading import Thread
-from collections import deque
+from threading import Thread, Event
+from collections import deque, defaultdict
 from ioc import Injectable, Inject, INJECTED, Singleton
 from bus.om_bus_events import OMBusEvents
 
 logger = logging.getLogger("openmotics")
 
+_METRIC_KEYS = 'type, timestamp, values, tags'
+_DEFINITION_KEYS = 'type, metrics, tags'
+_METRIC_DEFINITION_KEY_NAMES = ('name', 'description', 'type', 'unit')
+_METRIC_DEFINITION_KEYS = ', '.join(_METRIC_DEFINITION_KEY_NAMES)
+
 
 @Injectable.named('metrics_controller')
 @Singleton
@@ -58,8 +63,10 @@ class MetricsController(object):
         self._config_controller = configuration_controller
         self._persist_counters = {}
         self._buffer_counters = {}
+        self._definition_value_names = {}
         self.definitions = {}
         self._definition_filters = {'source': {}, 'metric_type': {}}
+        self._compiled_filters = {}
         self._metrics_cache = {}
         self._collector_plugins = None
         self._collector_openmotics = None
@@ -68,8 +75,14 @@ class MetricsController(object):
         self._distributor_openmotics = None
         self.metrics_queue_plugins = deque()
         self.metrics_queue_openmotics = deque()
-        self.inbound_rates = {'total': 0}
-        self.outbound_rates = {'total': 0}
+        self._metrics_event_plugins = Event()
+        self._metrics_event_openmotics = Event()
+        self.inbound_rates = defaultdict(int)
+        self.inbound_rates['total'] = 0
+        self.outbound_rates = defaultdict(int)
+        self.outbound_rates['total'] = 0
+        self.rate_keys = set(['total'])
+        self._rate_keys_by_source_type = {}
         self._openmotics_receivers = []
         self._cloud_cache = {}
         self._cloud_queue = []
@@ -79,6 +92,7 @@ class MetricsController(object):
         self._cloud_last_send = time.time()
         self._cloud_last_try = time.time()
         self._cloud_retry_interval = None
+        self._cloud_buffer_last_prune = 0
         self._gateway_uuid = gateway_uuid
         self.cloud_stats = {'queue': 0,
                             'buffer': self._cloud_buffer_length,
@@ -97,6 +111,7 @@ class MetricsController(object):
             settings = MetricsController._parse_definition(definition)
             self._persist_counters.setdefault('OpenMotics', {})[definition['type']] = settings['persist']
             self._buffer_counters.setdefault('OpenMotics', {})[definition['type']] = settings['buffer']
+            self._definition_value_names.setdefault('OpenMotics', {})[definition['type']] = MetricsController._get_value_names(definition)
 
     def start(self):
         self._collector_plugins = Thread(target=self._collect_plugins)
@@ -118,6 +133,8 @@ class MetricsController(object):
 
     def stop(self):
         self._stopped = True
+        self._metrics_event_plugins.set()
+        self._metrics_event_openmotics.set()
 
     def set_cloud_interval(self, metric_type, interval):
         logger.info('setting cloud interval {0}_{1}'.format(metric_type, interval))
@@ -133,7 +150,7 @@ class MetricsController(object):
             return self._definition_filters[filter_type][metric_filter]
         if filter_type == 'source':
             results = []
-            re_filter = None if metric_filter is None else re.compile(metric_filter)
+            re_filter = None if metric_filter is None else self._get_compiled(metric_filter)
             for source in self.definitions.keys():
                 if re_filter is None or re_filter.match(source):
                     results.append(source)
@@ -142,7 +159,7 @@ class MetricsController(object):
             return results
         if filter_type == 'metric_type':
             results = []
-            re_filter = None if metric_filter is None else re.compile(metric_filter)
+            re_filter = None if metric_filter is None else self._get_compiled(metric_filter)
             for source in self.definitions.keys():
                 for metric_type in self.definitions.get(source, []):
                     if re_filter is None or re_filter.match(metric_type):
@@ -151,6 +168,14 @@ class MetricsController(object):
             self._definition_filters['metric_type'][metric_filter] = results
             return results
 
+    def _get_compiled(self, pattern):
+        # The patterns are bounded (they originate from plugin and gateway configuration), so no eviction is needed
+        compiled = self._compiled_filters.get(pattern)
+        if compiled is None:
+            compiled = re.compile(pattern)
+            self._compiled_filters[pattern] = compiled
+        return compiled
+
     def set_plugin_definitions(self, definitions):
         # {
         #     "type": "energy",
@@ -160,66 +185,65 @@ class MetricsController(object):
         #                  "type": "counter",
         #                  "unit": "kWh"}]
         # }
-        required_keys = {'type': basestring,
-                         'metrics': list,
-                         'tags': list}
-        metrics_keys = {'name': basestring,
-                        'description': basestring,
-                        'type': basestring,
-                        'unit': basestring}
         expected_plugins = []
         for plugin, plugin_definitions in definitions.iteritems():
             log = self._plugin_controller.get_logger(plugin)
             for definition in plugin_definitions:
-                definition_ok = True
-                for key, key_type in required_keys.iteritems():
-                    if key not in definition:
-                        log('Definitions should contain keys: {0}'.format(', '.join(required_keys.keys())))
-                        definition_ok = False
-                        break
-                    if not isinstance(definition[key], key_type):
-                        log('Definitions key {0} should be of type {1}'.format(key, key_type))
-                        definition_ok = False
-                        break
-                    if key == 'metrics':
-                        for metric_definition in definition[key]:
-                            if definition_ok is False:
-                                break
-                            if not isinstance(metric_definition, dict):
-                                log('Metric definitions should be dictionaries')
-                                definition_ok = False
-                                break
-                            for mkey, mkey_type in metrics_keys.iteritems():
-                                if mkey not in metric_definition:
-                                    log('Metric definitions should contain keys: {0}'.format(', '.join(metrics_keys.keys())))
-                                    definition_ok = False
-                                    break
-                                if not isinstance(metric_definition[mkey], mkey_type):
-                                    log('Metric definitions key {0} should be of type {1}'.format(mkey, mkey_type))
-                                    definition_ok = False
-                                    break
-                    if definition_ok is False:
-                        break
-                if definition_ok is True:
-                    expected_plugins.append(plugin)
-                    self.definitions.setdefault(plugin, {})[definition['type']] = definition
-                    settings = MetricsController._parse_definition(definition)
-                    self._persist_counters.setdefault(plugin, {})[definition['type']] = settings['persist']
-                    self._buffer_counters.setdefault(plugin, {})[definition['type']] = settings['buffer']
+                if not MetricsController._validate_definition(definition, log):
+                    continue
+                expected_plugins.append(plugin)
+                # The value names are set first, as the collector expects them to be available for every known definition
+                self._definition_value_names.setdefault(plugin, {})[definition['type']] = MetricsController._get_value_names(definition)
+                self.definitions.setdefault(plugin, {})[definition['type']] = definition
+                settings = MetricsController._parse_definition(definition)
+                self._persist_counters.setdefault(plugin, {})[definition['type']] = settings['persist']
+                self._buffer_counters.setdefault(plugin, {})[definition['type']] = settings['buffer']
         for source in self.definitions.keys():
             # Remove plugins from the self.definitions dict that are not found anymore
             if source != 'OpenMotics' and source not in expected_plugins:
                 self.definitions.pop(source, None)
                 self._persist_counters.pop(source, None)
                 self._buffer_counters.pop(source, None)
+                self._definition_value_names.pop(source, None)
         self._definition_filters['source'] = {}
         self._definition_filters['metric_type'] = {}
 
+    @staticmethod
+    def _validate_definition(definition, log):
+        if 'type' not in definition or 'metrics' not in definition or 'tags' not in definition:
+            log('Definitions should contain keys: {0}'.format(_DEFINITION_KEYS))
+            return False
+        if not isinstance(definition['type'], basestring):
+            log('Definitions key type should be of type {0}'.format(basestring))
+            return False
+        if not isinstance(definition['metrics'], list):
+            log('Definitions key metrics should be of type {0}'.format(list))
+            return False
+        if not isinstance(definition['tags'], list):
+            log('Definitions key tags should be of type {0}'.format(list))
+            return False
+        for metric_definition in definition['metrics']:
+            if not isinstance(metric_definition, dict):
+                log('Metric definitions should be dictionaries')
+                return False
+            if 'name' not in metric_definition or 'description' not in metric_definition or 'type' not in metric_definition or 'unit' not in metric_definition:
+                log('Metric definitions should contain keys: {0}'.format(_METRIC_DEFINITION_KEYS))
+                return False
+            for mkey in _METRIC_DEFINITION_KEY_NAMES:
+                if not isinstance(metric_definition[mkey], basestring):
+                    log('Metric definitions key {0} should be of type {1}'.format(mkey, basestring))
+                    return False
+        return True
+
     def _load_cloud_buffer(self):
         oldest_queue_timestamp = min([time.time()] + [metric[0]['timestamp'] for metric in self._cloud_queue])
         self._cloud_buffer = [[metric] for metric in self._metrics_cache_controller.load_buffer(before=oldest_queue_timestamp)]
         self._cloud_buffer_length = len(self._cloud_buffer)
 
+    @staticmethod
+    def _get_value_names(definition):
+        return frozenset(metric['name'] for metric in definition['metrics'])
+
     @staticmethod
     def _parse_definition(definition):
         settings = {'persist': {},
@@ -314,7 +338,7 @@ class MetricsController(object):
 
         counters_to_buffer = self._buffer_counters.get(metric_source, {}).get(metric_type, {})
         definition = self.definitions.get(metric_source, {}).get(metric_type)
-        identifier = '|'.join(['{0}={1}'.format(tag, metric['tags'][tag]) for tag in sorted(definition['tags'])])
+        identifier = MetricsController._get_cloud_identifier(metric['tags'], definition['tags'])
 
         # Check if the metric needs to be send
         entry = self._cloud_cache.setdefault(metric_source, {}).setdefault(metric_type, {}).setdefault(identifier, {})
@@ -330,7 +354,8 @@ class MetricsController(object):
         if include_this_metric is True:
             entry['timestamp'] = timestamp
             self._cloud_queue.append([metric])
-            self._cloud_queue = self._cloud_queue[-5000:]  # 5k metrics buffer
+            if len(self._cloud_queue) > 5000:  # 5k metrics buffer
+                del self._cloud_queue[:-5000]
 
         # Check timings/rates
         now = time.time()
@@ -392,19 +417,32 @@ class MetricsController(object):
                 cache_data[counter] = metric['values'][counter]
             if self._metrics_cache_controller.buffer_counter(metric_source, metric_type, metric['tags'], cache_data, metric['timestamp']):
                 self._cloud_buffer_length += 1
-            if self._metrics_cache_controller.clear_buffer(time.time() - 365 * 24 * 60 * 60) > 0:
-                self._load_cloud_buffer()
+            if now - self._cloud_buffer_last_prune > 60:
+                # Pruning the year-old buffer entries is a database roundtrip, so it's only done once a minute
+                self._cloud_buffer_last_prune = now
+                if self._metrics_cache_controller.clear_buffer(time.time() - 365 * 24 * 60 * 60) > 0:
+                    self._load_cloud_buffer()
+
+    def get_rate_key(self, source, metric_type):
+        # The (source, type) pairs are bounded by the metric definitions, so the lowercased keys are built only once
+        rate_key = self._rate_keys_by_source_type.get((source, metric_type))
+        if rate_key is None:
+            rate_key = '{0}.{1}'.format(source.lower(), metric_type.lower())
+            self._rate_keys_by_source_type[(source, metric_type)] = rate_key
+            self.rate_keys.add(rate_key)
+        return rate_key
 
     def _put(self, metric):
-        rate_key = '{0}.{1}'.format(metric['source'].lower(), metric['type'].lower())
-        if rate_key not in self.inbound_rates:
-            self.inbound_rates[rate_key] = 0
+        rate_key = self.get_rate_key(metric['source'], metric['type'])
         self.inbound_rates[rate_key] += 1
         self.inbound_rates['total'] += 1
         self._transform_counters(metric)  # Convert counters to "ever increasing counters"
         # No need to make a deep copy; openmotics doesn't alter the object, and for the plugins the metric gets (de)serialized
-        self.metrics_queue_plugins.appendleft(metric)
-        self.metrics_queue_openmotics.appendleft(metric)
+        # The rate key is queued alongside the metric so the distributors don't have to recalculate it
+        self.metrics_queue_plugins.appendleft((rate_key, metric))
+        self.metrics_queue_openmotics.appendleft((rate_key, metric))
+        self._metrics_event_plugins.set()
+        self._metrics_event_openmotics.set()
 
     def _transform_counters(self, metric):
         source = metric['source']
@@ -442,47 +480,62 @@ class MetricsController(object):
         while not self._stopped:
             start = time.time()
             for metric in self._plugin_controller.collect_metrics():
-                # Validation, part 1
-                source = metric['source']
-                log = self._plugin_controller.get_logger(source)
-                required_keys = {'type': basestring,
-                                 'timestamp': (float, int),
-                                 'values': dict,
-                                 'tags': dict}
-                metric_ok = True
-                for key, key_type in required_keys.iteritems():
-                    if key not in metric:
-                        log('Metric should contain keys {0}'.format(', '.join(required_keys.keys())))
-                        metric_ok = False
-                        break
-                    if not isinstance(metric[key], key_type):
-                        log('Metric key {0} should be of type {1}'.format(key, key_type))
-                        metric_ok = False
-                        break
-                if metric_ok is False:
-                    continue
-                # Get metric definition
-                definition = self.definitions.get(metric['source'], {}).get(metric['type'])
-                if definition is None:
-                    continue
-                # Validate metric based on definition
-                for tag in definition['tags']:
-                    if tag not in metric['tags'] or metric['tags'][tag] is None:
-                        log('Metric tag {0} should be defined'.format(tag))
-                        metric_ok = False
-                metric_values = set(metric['values'].keys())
-                if len(metric_values) == 0:
-                    log('Metric should have at least one value')
-                    metric_ok = False
-                unknown_metrics = metric_values - set([mdef['name'] for mdef in definition['metrics']])
-                if len(unknown_metrics) > 0:
-                    log('Metric contains unknown values: {0}'.format(', '.join(unknown_metrics)))
-                    metric_ok = False
-                if metric_ok is False:
-                    continue
-                self._put(metric)
+                if self._validate_plugin_metric(metric):
+                    self._put(metric)
             if not self._stopped:
-                time.sleep(max(0.1, 1 - (time.time() - start)))
+                remaining = 1.0 - (time.time() - start)
+                time.sleep(remaining if remaining > 0.1 else 0.1)
+
+    @staticmethod
+    def _get_cloud_identifier(tags, tag_names):
+        """ The tag values are the natural key of a metric. Unhashable values (e.g. lists) fall back to a formatted key """
+        identifier = tuple(tags[tag] for tag in tag_names)
+        try:
+            hash(identifier)
+        except TypeError:
+            identifier = '|'.join('{0}={1}'.format(tag, tags[tag]) for tag in tag_names)
+        return identifier
+
+    def _validate_plugin_metric(self, metric):
+        source = metric['source']
+        # Validation, part 1
+        if 'type' not in metric or 'timestamp' not in metric or 'values' not in metric or 'tags' not in metric:
+            self._plugin_controller.get_logger(source)('Metric should contain keys {0}'.format(_METRIC_KEYS))
+            return False
+        if not isinstance(metric['type'], basestring):
+            self._plugin_controller.get_logger(source)('Metric key type should be of type {0}'.format(basestring))
+            return False
+        if not isinstance(metric['timestamp'], (float, int)):
+            self._plugin_controller.get_logger(source)('Metric key timestamp should be of type {0}'.format((float, int)))
+            return False
+        if not isinstance(metric['values'], dict):
+            self._plugin_controller.get_logger(source)('Metric key values should be of type {0}'.format(dict))
+            return False
+        if not isinstance(metric['tags'], dict):
+            self._plugin_controller.get_logger(source)('Metric key tags should be of type {0}'.format(dict))
+            return False
+        # Get metric definition
+        definition = self.definitions.get(source, {}).get(metric['type'])
+        # The definitions can be removed concurrently, so the value names might already be gone as well
+        value_names = self._definition_value_names.get(source, {}).get(metric['type'])
+        if definition is None or value_names is None:
+            return False
+        # Validate metric based on definition
+        metric_ok = True
+        tags = metric['tags']
+        for tag in definition['tags']:
+            if tags.get(tag) is None:
+                self._plugin_controller.get_logger(source)('Metric tag {0} should be defined'.format(tag))
+                metric_ok = False
+        metric_values = metric['values']
+        if len(metric_values) == 0:
+            self._plugin_controller.get_logger(source)('Metric should have at least one value')
+            metric_ok = False
+        if not value_names.issuperset(metric_values):
+            unknown_metrics = set(metric_values) - value_names
+            self._plugin_controller.get_logger(source)('Metric contains unknown values: {0}'.format(', '.join(unknown_metrics)))
+            metric_ok = False
+        return metric_ok
 
     def _collect_openmotics(self):
         while not self._stopped:
@@ -490,44 +543,56 @@ class MetricsController(object):
             for metric in self._metrics_collector.collect_metrics():
                 self._put(metric)
             if not self._stopped:
-                time.sleep(max(0.1, 1 - (time.time() - start)))
+                remaining = 1.0 - (time.time() - start)
+                time.sleep(remaining if remaining > 0.1 else 0.1)
 
     def _distribute_plugins(self):
         while not self._stopped:
             try:
+                # The event is cleared before draining, so a metric queued in the meantime will set it again
+                self._metrics_event_plugins.clear()
+                rate_keys = []
                 metrics = []
                 try:
                     while len(metrics) < 250:
-                        metrics.append(self.metrics_queue_plugins.pop())
+                        rate_key, metric = self.metrics_queue_plugins.pop()
+                        rate_keys.append(rate_key)
+                        metrics.append(metric)
                 except IndexError:
                     pass
                 if metrics:
-                    rates = self._plugin_controller.distribute_metrics(metrics)
+                    rates = self._plugin_controller.distribute_metrics(metrics, rate_keys)
                     for key, rate in rates.iteritems():
-                        if key not in self.outbound_rates:
-                            self.outbound_rates[key] = 0
                         self.outbound_rates[key] += rate
                 else:
-                    time.sleep(0.1)
+                    self._metrics_event_plugins.wait()
             except Exception as ex:
                 logger.exception('Error distributing metrics to plugins: {0}'.format(ex))
 
     def _distribute_openmotics(self):
         while not self._stopped:
+            self._metrics_event_openmotics.clear()
+            metrics = []
             try:
-                metric = self.metrics_queue_openmotics.pop()
-                for receiver in self._openmotics_receivers:
+                while len(metrics) < 250:
+                    metrics.append(self.metrics_queue_openmotics.pop())
+            except IndexError:
+                pass
+            if not metrics:
+                self._metrics_event_openmotics.wait()
+                continue
+            receivers = self._openmotics_receivers
+            rates = {}
+            for rate_key, metric in metrics:
+                for receiver in receivers:
                     try:
                         receiver(metric)
                     except Exception as ex:
                         logger.exception('Error distributing metrics to internal receivers: {0}'.format(ex))
-                    rate_key = '{0}.{1}'.format(metric['source'].lower(), metric['type'].lower())
-                    if rate_key not in self.outbound_rates:
-                        self.outbound_rates[rate_key] = 0
-                    self.outbound_rates[rate_key] += 1
-                    self.outbound_rates['total'] += 1
-            except IndexError:
-                time.sleep(0.1)
+                rates[rate_key] = rates.get(rate_key, 0) + len(receivers)
+            for rate_key, rate in rates.iteritems():
+                self.outbound_rates[rate_key] += rate
+            self.outbound_rates['total'] += len(metrics) * len(receivers)
 
     def event_receiver(self, event, payload):
         if event == OMBusEvents.METRICS_INTERVAL_CHANGE:
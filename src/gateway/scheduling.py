@@ -19,11 +19,13 @@ The scheduling module contains the SchedulingController, this controller is used
 import sqlite3
 import logging
 import time
+import heapq
 import pytz
 from datetime import datetime
 from croniter import croniter
 from random import randint
-from threading import Thread
+from threading import Thread, Lock
+from Queue import Queue
 from ioc import Injectable, Inject, INJECTED, Singleton
 from platform_utils import Platform
 from gateway.webservice import params_parser
@@ -39,10 +41,16 @@ else:
 
 logger = logging.getLogger('openmotics')
 
+_SELECT_SCHEDULES = 'SELECT id, name, start, repeat, duration, end, type, arguments, status FROM schedules;'
+_INSERT_SCHEDULE = 'INSERT INTO schedules (name, start, repeat, duration, end, type, arguments, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+_UPDATE_SCHEDULE_STATUS = 'UPDATE schedules SET status = ? WHERE id = ?;'
+_DELETE_SCHEDULE = 'DELETE FROM schedules WHERE id = ?;'
+
 
 class Schedule(object):
 
     timezone = None
+    _tzinfo = None
 
     def __init__(self, id, name, start, repeat, duration, end, schedule_type, arguments, status):
         self.id = id
@@ -56,28 +64,32 @@ class Schedule(object):
         self.status = status
         self.last_executed = None
         self.next_execution = None
+        self._cron = None
 
-    @property
-    def is_due(self):
-        if self.status != 'ACTIVE':
-            return False
+    @classmethod
+    def set_timezone(cls, timezone):
+        cls.timezone = timezone
+        cls._tzinfo = pytz.timezone(timezone)
+
+    def get_next_execution(self, now):
+        """
+        Returns the timestamp at which the schedule should be executed next, or None if it doesn't need to be executed anymore
+        """
         if self.repeat is None:
             # Single-run schedules should start on their set starting time if not yet executed
             if self.last_executed is not None:
-                return False
-            return self.start <= time.time()
+                return None
+            return self.start
         # Repeating
-        timezone = pytz.timezone(Schedule.timezone)
-        now = datetime.now(timezone)
-        cron = croniter(self.repeat, now)
-        next_execution = cron.get_next(ret_type=float)
-        if self.next_execution is None:
-            self.next_execution = next_execution
-            return False
-        if self.next_execution < time.time():
-            self.next_execution = next_execution
-            return True
-        return False
+        if self._cron is None:
+            self._cron = croniter(self.repeat, datetime.fromtimestamp(now, Schedule._tzinfo))
+        next_execution = self._cron.get_next(ret_type=float)
+        if next_execution <= now:
+            # The iterator fell behind (e.g. a time jump), so restart it from the current time
+            self._cron = croniter(self.repeat, datetime.fromtimestamp(now, Schedule._tzinfo))
+            next_execution = self._cron.get_next(ret_type=float)
+        self.next_execution = next_execution
+        return self.next_execution
 
     @property
     def has_ended(self):
@@ -124,6 +136,8 @@ class SchedulingController(object):
     * String: Cron format, docs at https://github.com/kiorky/croniter
     """
 
+    WORKERS = 4
+
     @Inject
     def __init__(self, scheduling_db=INJECTED, scheduling_db_lock=INJECTED, gateway_api=INJECTED):
         """
@@ -142,17 +156,26 @@ class SchedulingController(object):
                                            detect_types=sqlite3.PARSE_DECLTYPES,
                                            check_same_thread=False,
                                            isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
         self._cursor = self._connection.cursor()
+        # Readers and the writer don't block each other in WAL mode, so the retry in `_execute` is rarely needed
+        self._execute('PRAGMA journal_mode=WAL;')
+        self._execute('PRAGMA synchronous=NORMAL;')
         self._check_tables()
         self._schedules = {}
+        self._active_schedules = {}
+        self._heap = []  # Contains (<next execution>, <schedule id>) tuples
+        self._heap_lock = Lock()
         self._stop = False
         self._processor = None
+        self._workers = []
+        self._execution_queue = Queue()
         self._semaphore = None
 
         try:
-            Schedule.timezone = gateway_api.get_timezone()
+            Schedule.set_timezone(gateway_api.get_timezone())
         except Exception:
-            Schedule.timezone = 'UTC'
+            Schedule.set_timezone('UTC')
 
         self._load_schedule()
 
@@ -171,7 +194,7 @@ class SchedulingController(object):
             try:
                 return self._cursor.execute(*args, **kwargs)
             except sqlite3.OperationalError:
-                time.sleep(randint(1, 20) / 10.0)
+                time.sleep(randint(1, 2) / 10.0)
                 return self._cursor.execute(*args, **kwargs)
 
     def _check_tables(self):
@@ -182,29 +205,49 @@ class SchedulingController(object):
                       'repeat TEXT, duration INTEGER, end INTEGER, type TEXT, arguments TEXT, status TEXT);')
 
     def _load_schedule(self):
-        for row in self._execute('SELECT id, name, start, repeat, duration, end, type, arguments, status FROM schedules;'):
-            schedule_id = row[0]
+        for row in self._execute(_SELECT_SCHEDULES):
+            schedule_id = row['id']
             self._schedules[schedule_id] = Schedule(id=schedule_id,
-                                                    name=row[1],
-                                                    start=row[2],
-                                                    repeat=json.loads(row[3]) if row[3] is not None else None,
-                                                    duration=row[4],
-                                                    end=row[5],
-                                                    schedule_type=row[6],
-                                                    arguments=json.loads(row[7]) if row[7] is not None else None,
-                                                    status=row[8])
+                                                    name=row['name'],
+                                                    start=row['start'],
+                                                    repeat=json.loads(row['repeat']) if row['repeat'] is not None else None,
+                                                    duration=row['duration'],
+                                                    end=row['end'],
+                                                    schedule_type=row['type'],
+                                                    arguments=json.loads(row['arguments']) if row['arguments'] is not None else None,
+                                                    status=row['status'])
+        self._active_schedules = dict((schedule_id, schedule) for schedule_id, schedule in self._schedules.iteritems()
+                                      if schedule.status == 'ACTIVE')
+        self._build_heap()
+
+    def _build_heap(self):
+        now = time.time()
+        heap = []
+        for schedule in self._active_schedules.values():
+            next_execution = schedule.get_next_execution(now)
+            if next_execution is not None:
+                heap.append((next_execution, schedule.id))
+        heapq.heapify(heap)
+        with self._heap_lock:
+            self._heap = heap
 
     def _update_schedule_status(self, schedule_id, status):
-        self._execute('UPDATE schedules SET status = ? WHERE id = ?;', (status, schedule_id))
-        self._schedules[schedule_id].status = status
+        self._execute(_UPDATE_SCHEDULE_STATUS, (status, schedule_id))
+        schedule = self._schedules[schedule_id]
+        schedule.status = status
+        if status == 'ACTIVE':
+            self._active_schedules[schedule_id] = schedule
+        else:
+            self._active_schedules.pop(schedule_id, None)
 
     def remove_schedule(self, schedule_id):
-        self._execute('DELETE FROM schedules WHERE id = ?;', (schedule_id,))
+        self._execute(_DELETE_SCHEDULE, (schedule_id,))
         self._schedules.pop(schedule_id, None)
+        self._active_schedules.pop(schedule_id, None)
 
     def add_schedule(self, name, start, schedule_type, arguments, repeat, duration, end):
         self._validate(name, start, schedule_type, arguments, repeat, duration, end)
-        self._execute('INSERT INTO schedules (name, start, repeat, duration, end, type, arguments, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        self._execute(_INSERT_SCHEDULE,
                       (name,
                        start,
                        json.dumps(repeat) if repeat is not None else None,
@@ -220,19 +263,44 @@ class SchedulingController(object):
         self._processor = Thread(target=self._process)
         self._processor.daemon = True
         self._processor.start()
+        self._workers = []
+        for i in xrange(SchedulingController.WORKERS):
+            worker = Thread(target=self._work, name='Scheduling worker {0}'.format(i))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
 
     def stop(self):
         self._stop = True
+        for _ in self._workers:
+            self._execution_queue.put(None)  # Wakes up and stops a worker
+        self._workers = []
 
     def _process(self):
         while self._stop is False:
-            for schedule in self._schedules.values():
-                if schedule.status == 'ACTIVE' and schedule.is_due:
-                    thread = Thread(target=self._execute_schedule, args=(schedule,))
-                    thread.daemon = True
-                    thread.start()
-            now = int(time.time())
-            time.sleep(now - now % 60 + 60 - time.time())  # Wait for the next minute mark
+            now = time.time()
+            next_minute = int(now) - int(now) % 60 + 60
+            with self._heap_lock:
+                while self._heap and self._heap[0][0] <= now:
+                    _, schedule_id = heapq.heappop(self._heap)
+                    schedule = self._active_schedules.get(schedule_id)
+                    if schedule is None:
+                        continue  # Removed or no longer active schedules drop out of the heap
+                    if schedule.repeat is None and schedule.last_executed is not None:
+                        continue
+                    # Single-run schedules are checked again on the next minute mark, so a failed execution is retried
+                    next_execution = schedule.get_next_execution(now)
+                    heapq.heappush(self._heap, (max(next_execution, next_minute), schedule.id))
+                    self._execution_queue.put(schedule)
+                wake_up = next_minute if not self._heap else min(next_minute, self._heap[0][0])
+            time.sleep(max(0, wake_up - time.time()))  # Wait for the next execution, or the next minute mark at the latest
+
+    def _work(self):
+        while True:
+            schedule = self._execution_queue.get()  # Without a timeout, this doesn't poll on Python 2
+            if schedule is None:
+                return
+            self._execute_schedule(schedule)
 
     def _execute_schedule(self, schedule):
         """
@@ -88,6 +88,7 @@ class UCANCommandSpec(object):
 
         self.header_length = 2 + self._identifier.length
         self.headers = []
+        self.header_set = frozenset()
         self._response_instruction_by_hash = {}
 
     def set_identity(self, identity):
@@ -98,6 +99,7 @@ class UCANCommandSpec(object):
             hash_value = UCANCommandSpec.hash(instruction.instruction + destination_address)
             self.headers.append(hash_value)
             self._response_instruction_by_hash[hash_value] = instruction
+        self.header_set = frozenset(self.headers)
 
     def create_request_payloads(self, identity, fields):
         """
@@ -169,22 +171,14 @@ class UCANCommandSpec(object):
         :param data: Data for which to calculate the CRC
         :returns: CRC
         """
-        crc = 0
-        for data_byte in data:
-            crc += data_byte
-        return crc % 256
+        return sum(data) & 0xFF
 
     def extract_hash(self, payload):
         return UCANCommandSpec.hash(payload[0:self.header_length])
 
     @staticmethod
     def hash(entries):
-        times = 1
-        result = 0
-        for entry in entries:
-            result += (entry * 256 * times)
-            times += 1
-        return result
+        return 256 * sum(entry * times for times, entry in enumerate(entries, 1))
 
 
 class UCANPalletCommandSpec(UCANCommandSpec):
@@ -18,17 +18,19 @@ Module to communicate with the uCANs.
 
 import logging
 import time
-from Queue import Queue, Empty
+from threading import Event
 from ioc import Injectable, Inject, INJECTED, Singleton
 from master_core.core_api import CoreAPI
 from master_core.core_communicator import BackgroundConsumer
 from master_core.exceptions import BootloadingException
-from master_core.ucan_command import SID
+from master_core.ucan_command import SID, UCANCommandSpec
 from master_core.ucan_api import UCANAPI
 from serial_utils import CommunicationTimedOutException, printable
 
 logger = logging.getLogger('openmotics')
 
+_PADDING = (0,) * 8
+
 
 @Injectable.named('ucan_communicator')
 @Singleton
@@ -49,6 +51,7 @@ class UCANCommunicator(object):
         self._communicator = master_communicator
         self._read_buffer = []
         self._consumers = {}
+        self._consumers_by_hash = {}
         self._cc_pallet_mode = {}
 
         self._background_consumer = BackgroundConsumer(CoreAPI.ucan_rx_transport_message(), 1, self._process_transport_message)
@@ -75,6 +78,11 @@ class UCANCommunicator(object):
         :type consumer: Consumer or PalletConsumer.
         """
         self._consumers.setdefault(consumer.cc_address, []).append(consumer)
+        command = consumer.command
+        if command.headers:
+            consumers_by_hash = self._consumers_by_hash.setdefault(consumer.cc_address, {}).setdefault(command.header_length, {})
+            for payload_hash in command.headers:
+                consumers_by_hash.setdefault(payload_hash, []).append(consumer)
 
     def unregister_consumer(self, consumer):
         """
@@ -85,6 +93,14 @@ class UCANCommunicator(object):
         consumers = self._consumers.get(consumer.cc_address, [])
         if consumer in consumers:
             consumers.remove(consumer)
+        command = consumer.command
+        consumers_by_hash = self._consumers_by_hash.get(consumer.cc_address, {}).get(command.header_length, {})
+        for payload_hash in command.headers:
+            consumers = consumers_by_hash.get(payload_hash, [])
+            if consumer in consumers:
+                consumers.remove(consumer)
+            if not consumers:
+                consumers_by_hash.pop(payload_hash, None)
 
     def do_command(self, cc_address, command, identity, fields, timeout=2):
         """
@@ -119,13 +135,15 @@ class UCANCommunicator(object):
         master_timeout = False
         for payload in command.create_request_payloads(identity, fields):
             if self._verbose:
-                logger.info('Writing to uCAN transport:   CC {0} - SID {1} - Data: {2}'.format(cc_address, command.sid, printable(payload)))
+                logger.info('Writing to uCAN transport:   CC %s - SID %s - Data: %s', cc_address, command.sid, printable(payload))
+            nr_can_bytes = len(payload)
+            payload.extend(_PADDING[nr_can_bytes:])  # Payloads are freshly built, so they can be padded in place
             try:
                 self._communicator.do_command(command=CoreAPI.ucan_tx_transport_message(),
                                               fields={'cc_address': cc_address,
-                                                      'nr_can_bytes': len(payload),
+                                                      'nr_can_bytes': nr_can_bytes,
                                                       'sid': command.sid,
-                                                      'payload': payload + [0] * (8 - len(payload))},
+                                                      'payload': payload},
                                               timeout=timeout)
             except CommunicationTimedOutException as ex:
                 logger.error('Internal timeout during uCAN transport to CC {0}: {1}'.format(cc_address, ex))
@@ -133,6 +151,9 @@ class UCANCommunicator(object):
                 break
 
         consumer.check_send_only()
+        if not command.headers and command.sid != SID.BOOTLOADER_PALLET:
+            # Send-only commands don't expect a response, so their consumer won't be offered any payload
+            self.unregister_consumer(consumer)
         if master_timeout:
             # When there's a communication timeout with the master, catch this exception and timeout the consumer
             # so it uses a flow expected by the caller
@@ -150,12 +171,18 @@ class UCANCommunicator(object):
         sid = package['sid']
         cc_address = package['cc_address']
         if self._verbose:
-            logger.info('Reading from uCAN transport: CC {0} - SID {1} - Data: {2}'.format(cc_address, sid, printable(payload)))
+            logger.info('Reading from uCAN transport: CC %s - SID %s - Data: %s', cc_address, sid, printable(payload))
 
-        consumers = self._consumers.get(cc_address, [])
-        for consumer in consumers[:]:
-            if consumer.suggest_payload(payload):
-                self.unregister_consumer(consumer)
+        if self._cc_pallet_mode.get(cc_address, False) is True:
+            # Pallets don't carry a command header, so all consumers get a chance to consume the payload
+            consumers = self._consumers.get(cc_address, [])
+        else:
+            consumers = []
+            for header_length, consumers_by_hash in self._consumers_by_hash.get(cc_address, {}).iteritems():
+                consumers += consumers_by_hash.get(UCANCommandSpec.hash(payload[0:header_length]), [])
+        finished_consumers = [consumer for consumer in consumers if consumer.suggest_payload(payload)]
+        for consumer in finished_consumers:
+            self.unregister_consumer(consumer)
 
 
 class Consumer(object):
@@ -167,22 +194,32 @@ class Consumer(object):
     def __init__(self, cc_address, command):
         self.cc_address = cc_address
         self.command = command
-        self._queue = Queue()
+        self._result = None
+        self._event = Event()
         self._payload_set = {}
+        # The command's identity is set before the consumer is created, so these can be cached
+        self._header_length = command.header_length
+        self._headers = command.header_set
+        self._amount_of_headers = len(command.headers)
+        self._send_only = len(command.response_instructions) == 0
 
     def suggest_payload(self, payload):
         """ Consume payload if needed """
-        payload_hash = self.command.extract_hash(payload)
-        if payload_hash in self.command.headers:
+        payload_hash = UCANCommandSpec.hash(payload[0:self._header_length])
+        if payload_hash in self._headers:
             self._payload_set[payload_hash] = payload
-        if len(self._payload_set) == len(self.command.headers):
-            self._queue.put(self.command.consume_response_payload(self._payload_set))
+        if len(self._payload_set) == self._amount_of_headers:
+            self._set_result(self.command.consume_response_payload(self._payload_set))
             return True
         return False
 
     def check_send_only(self):
-        if len(self.command.response_instructions) == 0:
-            self._queue.put(None)
+        if self._send_only:
+            self._set_result(None)
+
+    def _set_result(self, result):
+        self._result = result
+        self._event.set()
 
     def get(self, timeout):
         """
@@ -192,14 +229,12 @@ class Consumer(object):
         :raises: :class`CommunicationTimedOutException` if Core did not respond in time
         :returns: dict containing the output fields of the command
         """
-        try:
-            value = self._queue.get(timeout=timeout)
-            if value is None:
-                # No valid data could be received
-                raise CommunicationTimedOutException('Empty or invalid uCAN data received')
-            return value
-        except Empty:
+        if not self._event.wait(timeout):
             raise CommunicationTimedOutException('No uCAN data received in {0}s'.format(timeout))
+        if self._result is None:
+            # No valid data could be received
+            raise CommunicationTimedOutException('Empty or invalid uCAN data received')
+        return self._result
 
     def __str__(self):
         return 'Communicator(\'{0}\', {1})'.format(self.cc_address, self.command.instruction.instruction)
@@ -233,7 +268,7 @@ class PalletConsumer(Consumer):
             pallet = []
             for segment in sorted(self._payload_set.keys(), reverse=True):
                 pallet += self._payload_set[segment]
-            self._queue.put(self.command.consume_response_payload(pallet))
+            self._set_result(self.command.consume_response_payload(pallet))
             return True
         return False
 
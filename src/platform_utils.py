@@ -114,16 +114,21 @@ class System(object):
         ANGSTROM = 'angstrom'
         DEBIAN = 'debian'
 
+    _operating_system = None
+
     @staticmethod
     def _get_operating_system():
-        operating_system = {}
-        with open('/etc/os-release', 'r') as osfh:
-            lines = osfh.readlines()
-            for line in lines:
-                k, v = line.strip().split('=')
-                operating_system[k] = v
-        operating_system['ID'] = operating_system['ID'].lower()
-        return operating_system
+        # The operating system doesn't change at runtime, so /etc/os-release is only parsed once
+        if System._operating_system is None:
+            operating_system = {}
+            with open('/etc/os-release', 'r') as osfh:
+                lines = osfh.readlines()
+                for line in lines:
+                    k, v = line.strip().split('=')
+                    operating_system[k] = v
+            operating_system['ID'] = operating_system['ID'].lower()
+            System._operating_system = operating_system
+        return System._operating_system
 
     @staticmethod
     def get_ip_address():
@@ -345,16 +345,16 @@ class PluginController(object):
                 else:
                     yield metric
 
-    def distribute_metrics(self, metrics):
-        """ Enqueues all metrics in a separate queue per plugin """
+    def distribute_metrics(self, metrics, rate_keys=None):
+        """
+        Enqueues all metrics in a separate queue per plugin
+        :param rate_keys: The rate key of every metric, if already known
+        """
         rates = {'total': 0}
-        rate_keys = []
-        # Preprocess rate keys
-        for metric in metrics:
-            rate_key = '{0}.{1}'.format(metric['source'].lower(), metric['type'].lower())
-            if rate_key not in rates:
-                rates[rate_key] = 0
-            rate_keys.append(rate_key)
+        if rate_keys is None:
+            rate_keys = [self.__metrics_controller.get_rate_key(metric['source'], metric['type']) for metric in metrics]
+        for rate_key in rate_keys:
+            rates[rate_key] = 0
         # Distribute
         for runner in self.__iter_running_runners():
             for receiver in runner.get_metric_receivers():
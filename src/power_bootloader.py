@@ -22,8 +22,10 @@ import intelhex
 import constants
 import sys
 import argparse
+import struct
 import logging
 import time
+from threading import Thread
 from ioc import Injectable
 from ConfigParser import ConfigParser
 from serial import Serial
@@ -37,6 +39,11 @@ from power.power_api import bootloader_goto, bootloader_read_id, bootloader_writ
 
 logger = logging.getLogger("openmotics")
 
+_V8_VECTOR_ADDRESSES = tuple(xrange(0, 1024, 128))  # 0x000 - 0x400
+_V8_CODE_ADDRESSES = tuple(xrange(8192, 44032, 128))  # 0x2000 - 0xAC00
+_V12_ERASE_PAGES = tuple(xrange(6, 64))
+_V12_WRITE_ADDRESSES = tuple(xrange(0x1D006000, 0x1D03FFFB, 128))
+
 
 def setup_logger():
     """ Setup the OpenMotics logger. """
@@ -57,67 +64,62 @@ def setup_logger():
 class HexReader(object):
     """ Reads the hex from file and returns it in the OpenMotics format. """
 
+    IMAGE_8 = (0, 2 * 44032 - 1)  # 0x0000 - 0xAC00, two bytes per address
+    IMAGE_12 = (0x1D006000, 0x1D03FFFF)
+
     def __init__(self, hex_file):
         """ Constructor with the name of the hex file. """
         self.__hex = intelhex.IntelHex(hex_file)
+        self.__image = None
+        self.__image_start = None
         self.__crc = 0
 
+    def __read(self, start, size, image):
+        """ Read a block from the dense image, which is materialized on first use. """
+        image_start, image_end = image
+        if self.__image_start != image_start:
+            self.__image = self.__hex.tobinarray(start=image_start, end=image_end)
+            self.__image_start = image_start
+        offset = start - image_start
+        return self.__image[offset:offset + size]
+
     def get_bytes_version_8(self, address):
         """ Get the 192 bytes from the hex file, with 3 address bytes prepended. """
-        data_bytes = [address % 256,
-                      (address % 65536) / 256,
-                      address / 65536]
-
-        iaddress = address * 2
-        for i in range(64):
-            data0 = self.__hex[iaddress + (4 * i) + 0]
-            data1 = self.__hex[iaddress + (4 * i) + 1]
-            data2 = self.__hex[iaddress + (4 * i) + 2]
-
-            if address == 0 and i == 0:  # Set the start address to the bootloader: 0x400
-                data1 = 4
+        block = self.__read(address * 2, 256, HexReader.IMAGE_8)
+        del block[3::4]  # Every fourth byte is a phantom byte
 
-            data_bytes.append(data0)
-            data_bytes.append(data1)
-            data_bytes.append(data2)
+        if address == 0:  # Set the start address to the bootloader: 0x400
+            block[1] = 4
 
-            if not (address == 43904 and i >= 62):  # Don't include the CRC bytes in the CRC
-                self.__crc += data0 + data1 + data2
+        data_bytes = bytearray(struct.pack('<I', address)[:3])
+        data_bytes.extend(block)
 
-        if address == 43904:  # Add the CRC at the end of the program
-            data_bytes[-1] = self.__crc % 256
-            data_bytes[-2] = (self.__crc % (256 * 256)) / 256
-            data_bytes[-3] = (self.__crc % (256 * 256 * 256)) / (256 * 256)
-            data_bytes[-4] = (self.__crc % (256 * 256 * 256 * 256)) / (256 * 256 * 256)
+        if address == 43904:  # Don't include the CRC bytes in the CRC
+            self.__crc += sum(block[:-6])
+            # Add the CRC at the end of the program
+            data_bytes[-4:] = struct.pack('>I', self.__crc & 0xFFFFFFFF)
+        else:
+            self.__crc += sum(block)
 
         return data_bytes
 
     @staticmethod
     def int_to_array_12(integer):
         """ Convert an integer to an array for the 12 port energy module. """
-        return [integer % 256, (integer % 65536) / 256, (integer / 65536) % 256, (integer / 65536) / 256]
+        return list(bytearray(struct.pack('<I', integer)))
 
     def get_bytes_version_12(self, address):
         """ Get the 128 bytes from the hex file, with 4 address bytes prepended. """
-        data_bytes = self.int_to_array_12(address)
-
-        for i in range(32):
-            data0 = self.__hex[address + (4 * i) + 0]
-            data1 = self.__hex[address + (4 * i) + 1]
-            data2 = self.__hex[address + (4 * i) + 2]
-            data3 = self.__hex[address + (4 * i) + 3]
-
-            data_bytes.append(data0)
-            data_bytes.append(data1)
-            data_bytes.append(data2)
-            data_bytes.append(data3)
+        block = self.__read(address, 128, HexReader.IMAGE_12)
 
-            if not (address == 486801280 and i == 31):
-                self.__crc += data0 + data1 + data2 + data3
+        data_bytes = bytearray(struct.pack('<I', address))
+        data_bytes.extend(block)
 
         if address == 486801280:
-            data_bytes = data_bytes[:-4]
-            data_bytes += self.int_to_array_12(self.get_crc())
+            self.__crc += sum(block[:-4])
+            data_bytes[-4:] = struct.pack('<I', self.__crc)
+        else:
+            self.__crc += sum(block)
 
         return data_bytes
 
@@ -161,15 +163,17 @@ def bootload_8(module_address, hex_file, power_communicator):
     if chip_id[0] != 213:
         raise Exception('Unknown chip id: {0}'.format(chip_id[0]))
 
+    write_code = bootloader_write_code(POWER_API_8_PORTS)
+
     logger.info('E{0} - Writing vector tabel'.format(module_address))
-    for address in range(0, 1024, 128):      # 0x000 - 0x400
+    for address in _V8_VECTOR_ADDRESSES:
         data = reader.get_bytes_version_8(address)
-        power_communicator.do_command(module_address, bootloader_write_code(POWER_API_8_PORTS), *data)
+        power_communicator.do_command(module_address, write_code, *data)
 
     logger.info('E{0} -  Writing code'.format(module_address))
-    for address in range(8192, 44032, 128):  # 0x2000 - 0xAC00
+    for address in _V8_CODE_ADDRESSES:
         data = reader.get_bytes_version_8(address)
-        power_communicator.do_command(module_address, bootloader_write_code(POWER_API_8_PORTS), *data)
+        power_communicator.do_command(module_address, write_code, *data)
 
     logger.info('E{0} - Jumping to application'.format(module_address))
     power_communicator.do_command(module_address, bootloader_jump_application())
@@ -203,13 +207,15 @@ def bootload_12(module_address, hex_file, power_communicator):
 
     try:
         logger.info('E{0} - Erasing code...'.format(module_address))
-        for page in range(6, 64):
-            power_communicator.do_command(module_address, bootloader_erase_code(), page)
+        erase_code = bootloader_erase_code()
+        for page in _V12_ERASE_PAGES:
+            power_communicator.do_command(module_address, erase_code, page)
 
         logger.info('E{0} - Writing code...'.format(module_address))
-        for address in range(0x1D006000, 0x1D03FFFB, 128):
+        write_code = bootloader_write_code(POWER_API_12_PORTS)
+        for address in _V12_WRITE_ADDRESSES:
             data = reader.get_bytes_version_12(address)
-            power_communicator.do_command(module_address, bootloader_write_code(POWER_API_12_PORTS), *data)
+            power_communicator.do_command(module_address, write_code, *data)
     finally:
         logger.info('E{0} - Jumping to application'.format(module_address))
         power_communicator.do_command(module_address, bootloader_jump_application())
@@ -265,17 +271,27 @@ def main():
             elif not is_power_module and _module['version'] == POWER_API_12_PORTS:
                 bootload_12(_module_address, filename, power_communicator)
         except CommunicationTimedOutException:
-            logger.warning('E{0} - Module unavailable. Skipping...'.format(address))
+            logger.warning('E{0} - Module unavailable. Skipping...'.format(_module_address))
         except Exception:
-            logger.exception('E{0} - Unexpected exception during bootload. Skipping...'.format(address))
+            logger.exception('E{0} - Unexpected exception during bootload. Skipping...'.format(_module_address))
 
     if args.address or args.all:
         power_modules = power_controller.get_power_modules()
         if args.all:
+            # The serial communication is serialized by the PowerCommunicator, but all
+            # other work (e.g. reading the hex file, waiting for modules) can overlap
+            threads = []
             for module_id in power_modules:
                 module = power_modules[module_id]
                 address = module['address']
-                _bootload(module, address, args.file, is_power_module=args.old)
+                thread = Thread(target=_bootload,
+                                args=(module, address, args.file),
+                                kwargs={'is_power_module': args.old},
+                                name='Bootloader E{0}'.format(address))
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
         else:
             address = args.address
             modules = [module for module in power_modules.values() if module['address'] == address]
@@ -23,7 +23,9 @@ System.import_eggs()
 
 import logging
 import os
-import glob
+import errno
+import socket
+import struct
 import requests
 import time
 import subprocess
@@ -31,8 +33,11 @@ import traceback
 import constants
 import ujson as json
 
-from threading import Thread, Lock
+from threading import Lock
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 from collections import deque
+from operator import itemgetter
 from ConfigParser import ConfigParser
 from ioc import Injectable, INJECTED, Inject
 from gateway.config import ConfigurationController
@@ -41,9 +46,20 @@ from bus.om_bus_events import OMBusEvents
 
 REBOOT_TIMEOUT = 900
 DEFAULT_SLEEP_TIME = 30
+COLLECTOR_WORKERS = 4
+COLLECTOR_TIMEOUT = 20
+PING_POLL_INTERVAL = 0.1
+CONNECTIVITY_CACHE_TIME = 60
+DEBUG_DUMP_FOLDER = '/tmp'
 
 logger = logging.getLogger("openmotics")
 
+_get_id_and_dimmer = itemgetter('id', 'dimmer')
+_get_id_and_status = itemgetter('id', 'status')
+_get_error_count = itemgetter(1)
+_THERMOSTAT_FIELDS = ('id', 'act', 'csetp', 'mode', 'output0', 'output1', 'outside', 'airco')
+_get_thermostat_fields = itemgetter(*_THERMOSTAT_FIELDS)
+
 
 def setup_logger():
     """ Setup the OpenMotics logger. """
@@ -58,60 +74,102 @@ def setup_logger():
 
 def reboot_gateway():
     """ Reboot the gateway. """
-    subprocess.call('sync && reboot', shell=True)
+    if subprocess.call(['sync']) == 0:
+        subprocess.call(['reboot'])
+
+
+def get_routes(route_file_path='/proc/net/route'):
+    """
+    Read the IPv4 routing table from /proc, which avoids spawning `ip` and friends.
+    :returns: List of (interface, destination, gateway, mask) tuples, with the addresses in dotted notation
+    """
+    routes = []
+    with open(route_file_path, 'r') as route_file:
+        next(route_file)  # Header
+        for line in route_file:
+            fields = line.split()
+            if len(fields) < 8:
+                continue
+            interface, destination, gateway, mask = fields[0], fields[1], fields[2], fields[7]
+            routes.append((interface,
+                           socket.inet_ntoa(struct.pack('<I', int(destination, 16))),
+                           socket.inet_ntoa(struct.pack('<I', int(gateway, 16))),
+                           socket.inet_ntoa(struct.pack('<I', int(mask, 16)))))
+    return routes
 
 
 class VpnController(object):
     """ Contains methods to check the vpn status, start and stop the vpn. """
 
     vpn_service = System.get_vpn_service()
-    start_cmd = "systemctl start " + vpn_service + " > /dev/null"
-    stop_cmd = "systemctl stop " + vpn_service + " > /dev/null"
-    check_cmd = "systemctl is-active " + vpn_service + " > /dev/null"
+    start_cmd = ['systemctl', 'start', vpn_service]
+    stop_cmd = ['systemctl', 'stop', vpn_service]
+    check_cmd = ['systemctl', 'is-active', vpn_service]
+    check_interval = 30
+
+    _last_known_state = None
+    _last_checked = 0
 
     def __init__(self):
-        self.vpn_connected = False
-        t_vpn_connected = Thread(target=self._vpn_connected)
-        t_vpn_connected.daemon = True
-        t_vpn_connected.start()
+        self._tunnel_up = False
+        self._last_tunnel_check = None
 
     @staticmethod
     def start_vpn():
         """ Start openvpn """
         logger.info('Starting VPN')
-        return subprocess.call(VpnController.start_cmd, shell=True) == 0
+        success = VpnController._systemctl(VpnController.start_cmd)
+        VpnController._set_known_state(True if success else None)
+        return success
 
     @staticmethod
     def stop_vpn():
         """ Stop openvpn """
         logger.info('Stopping VPN')
-        return subprocess.call(VpnController.stop_cmd, shell=True) == 0
+        success = VpnController._systemctl(VpnController.stop_cmd)
+        VpnController._set_known_state(False if success else None)
+        return success
 
     @staticmethod
     def check_vpn():
-        """ Check if openvpn is running """
-        return subprocess.call(VpnController.check_cmd, shell=True) == 0
+        """ Check if openvpn is running. The state is only queried from systemd every `check_interval` seconds """
+        if VpnController._last_known_state is not None and 0 <= time.time() - VpnController._last_checked < VpnController.check_interval:
+            return VpnController._last_known_state
+        is_running = VpnController._systemctl(VpnController.check_cmd)
+        VpnController._set_known_state(is_running)
+        return is_running
 
-    def _vpn_connected(self):
-        """ Checks if the VPN tunnel is connected """
-        while True:
-            try:
-                routes = subprocess.check_output('ip r | grep tun | grep via || true', shell=True).strip()
-                # example output:
-                # 10.0.0.0/24 via 10.37.0.5 dev tun0\n
-                # 10.37.0.1 via 10.37.0.5 dev tun0
-                result = False
-                if routes:
-                    vpn_servers = [route.split(' ')[0] for route in routes.split('\n') if '/' not in route]
-                    for vpn_server in vpn_servers:
-                        if VPNService.ping(vpn_server, verbose=False):
-                            result = True
-                            break
-                self.vpn_connected = result
-            except Exception as ex:
-                logger.info('Exception occured during vpn connectivity test: {0}'.format(ex))
-                self.vpn_connected = False
-            time.sleep(5)
+    @staticmethod
+    def _systemctl(command):
+        """ Run a systemctl command without a shell, discarding its output. Returns whether it succeeded """
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(command, stdout=devnull) == 0
+
+    @staticmethod
+    def _set_known_state(state):
+        """ Remember the openvpn state. A state of None forces the next check to query systemd """
+        VpnController._last_known_state = state
+        VpnController._last_checked = time.time()
+
+    def is_tunnel_up(self):
+        """ Checks if the VPN tunnel is connected. The result is cached for `check_interval` seconds """
+        if self._last_tunnel_check is not None and 0 <= time.time() - self._last_tunnel_check < VpnController.check_interval:
+            return self._tunnel_up
+        try:
+            # The VPN servers are the host routes through the tunnel, e.g. `10.37.0.1 via 10.37.0.5 dev tun0`
+            vpn_servers = [destination for interface, destination, gateway, mask in get_routes()
+                           if 'tun' in interface and gateway != '0.0.0.0' and mask == '255.255.255.255']
+            result = False
+            for vpn_server in vpn_servers:
+                if VPNService.ping(vpn_server, verbose=False):
+                    result = True
+                    break
+        except Exception as ex:
+            logger.info('Exception occured during vpn connectivity test: {0}'.format(ex))
+            result = False
+        self._tunnel_up = result
+        self._last_tunnel_check = time.time()
+        return result
 
 
 class Cloud(object):
@@ -125,14 +183,15 @@ class Cloud(object):
         self.__config = config
         self.__intervals = {}
         self.__configuration = {}
+        self.__session = requests.Session()  # Keeps the connection to the cloud alive between calls
 
     def call_home(self, extra_data):
         """ Call home reporting our state, and optionally get new settings or other stuff """
         try:
-            request = requests.post(self.__url,
-                                    data={'extra_data': json.dumps(extra_data)},
-                                    timeout=10.0)
-            data = json.loads(request.text)
+            request = self.__session.post(self.__url,
+                                          data={'extra_data': json.dumps(extra_data)},
+                                          timeout=10.0)
+            data = json.loads(request.content)
 
             if 'sleep_time' in data:
                 self.__sleep_time = data['sleep_time']
@@ -140,7 +199,7 @@ class Cloud(object):
                 self.__sleep_time = DEFAULT_SLEEP_TIME
 
             if 'configuration' in data:
-                configuration_changed = cmp(self.__configuration, data['configuration']) != 0
+                configuration_changed = self.__configuration != data['configuration']
                 if configuration_changed:
                     for setting, value in data['configuration'].iteritems():
                         self.__config.set_setting(setting, value)
@@ -151,7 +210,7 @@ class Cloud(object):
 
             if 'intervals' in data:
                 # check if interval changes occurred and distribute interval changes
-                intervals_changed = cmp(self.__intervals, data['intervals']) != 0
+                intervals_changed = self.__intervals != data['intervals']
                 if intervals_changed:
                     self.__message_client.send_event(OMBusEvents.METRICS_INTERVAL_CHANGE, data['intervals'])
                     logger.info('intervals changed: {0}'.format(data['intervals']))
@@ -184,12 +243,13 @@ class Gateway(object):
     def __init__(self, host="127.0.0.1"):
         self.__host = host
         self.__last_pulse_counters = None
+        self.__session = requests.Session()  # Keeps the connection to the webservice alive between calls
 
     def do_call(self, uri):
         """ Do a call to the webservice, returns a dict parsed from the json returned by the webserver. """
         try:
-            request = requests.get("http://" + self.__host + "/" + uri, timeout=15.0)
-            return json.loads(request.text)
+            request = self.__session.get("http://" + self.__host + "/" + uri, timeout=15.0)
+            return json.loads(request.content)
         except Exception as ex:
             logger.info('Exception during Gateway call: {0} {1}'.format(ex, uri))
             return
@@ -209,37 +269,28 @@ class Gateway(object):
             counters = data['counters']
 
             if self.__last_pulse_counters is None:
-                ret = [0 for _ in xrange(0, 24)]
+                ret = [0] * 24
             else:
-                ret = [Gateway.__counter_diff(counters[i], self.__last_pulse_counters[i])
-                       for i in xrange(0, 24)]
+                # The counters are 16 bit, so a modulo takes care of the wrap-around
+                previous_counters = self.__last_pulse_counters
+                ret = [(counters[i] - previous_counters[i]) % 65536 for i in xrange(0, 24)]
 
             self.__last_pulse_counters = counters
             return ret
         return
 
-    @staticmethod
-    def __counter_diff(current, previous):
-        """ Calculate the diff between two counter values. """
-        diff = current - previous
-        return diff if diff >= 0 else 65536 - previous + current
-
     def get_enabled_outputs(self):
         """ Get the enabled outputs. """
         data = self.do_call("get_output_status?token=None")
         if data is not None and data['success']:
-            ret = []
-            for output in data['status']:
-                if output["status"] == 1:
-                    ret.append((output["id"], output["dimmer"]))
-            return ret
+            return [_get_id_and_dimmer(output) for output in data['status'] if output['status'] == 1]
         return
 
     def get_inputs_status(self):
         """ Get the inputs status. """
         data = self.do_call("get_input_status?token=None")
         if data is not None and data['success']:
-            return [(inp["id"], inp["status"]) for inp in data['status']]
+            return map(_get_id_and_status, data['status'])
         return
 
     def get_thermostats(self):
@@ -250,23 +301,15 @@ class Gateway(object):
         ret = {'thermostats_on': data['thermostats_on'],
                'automatic': data['automatic'],
                'cooling': data['cooling']}
-        thermostats = []
-        for thermostat in data['status']:
-            to_add = {}
-            for field in ['id', 'act', 'csetp', 'mode', 'output0', 'output1', 'outside', 'airco']:
-                to_add[field] = thermostat[field]
-            thermostats.append(to_add)
-        ret['status'] = thermostats
+        ret['status'] = [dict(zip(_THERMOSTAT_FIELDS, _get_thermostat_fields(thermostat)))
+                         for thermostat in data['status']]
         return ret
 
     def get_errors(self):
         """ Get the errors on the gateway. """
         data = self.do_call("get_errors?token=None")
         if data:
-            if data['errors'] is not None:
-                master_errors = sum([error[1] for error in data['errors']])
-            else:
-                master_errors = 0
+            master_errors = sum(map(_get_error_count, data['errors'] or ()))
 
             return {'master_errors': master_errors,
                     'master_last_success': data['master_last_success'],
@@ -291,17 +334,21 @@ class DataCollector(object):
         self.__period = period
         self.__last_collect = 0
 
-    def __should_collect(self):
+    def should_collect(self, now=None):
         """ Should we execute the collect? """
+        if now is None:
+            now = time.time()
+        # A last collect in the future means the clock jumped backwards, which shouldn't block collecting
+        return self.__period == 0 or not (self.__last_collect <= now < self.__last_collect + self.__period)
 
-        return self.__period == 0 or time.time() >= self.__last_collect + self.__period
-
-    def collect(self):
+    def collect(self, now=None):
         """ Execute the collect if required, return None otherwise. """
+        if now is None:
+            now = time.time()
         try:
-            if self.__should_collect():
+            if self.should_collect(now):
                 if self.__period != 0:
-                    self.__last_collect = time.time()
+                    self.__last_collect = now
                 return self.__function()
             else:
                 return
@@ -314,6 +361,8 @@ class DataCollector(object):
 class VPNService(object):
     """ The VPNService contains all logic to be able to send the heartbeat and check whether the VPN should be opened """
 
+    _connectivity_cache = (None, None)
+
     @Inject
     def __init__(self, configuration_controller=INJECTED):
         config = ConfigParser()
@@ -330,7 +379,9 @@ class VPNService(object):
         self._previous_sleep_time = 0
         self._vpn_open = False
         self._debug_data = {}
+        self._debug_mtimes = {}
         self._eeprom_events = deque()
+        self._eeprom_events_lock = Lock()
         self._gateway = Gateway()
         self._vpn_controller = VpnController()
         self._config_controller = configuration_controller
@@ -345,10 +396,15 @@ class VPNService(object):
                             'power': DataCollector(self._gateway.get_real_time_power),
                             'errors': DataCollector(self._gateway.get_errors, 600),
                             'local_ip': DataCollector(self._gateway.get_local_ip_address, 1800)}
+        # The collectors mostly wait on the webservice, so they can run concurrently
+        self._collector_pool = ThreadPool(COLLECTOR_WORKERS)
 
     @staticmethod
     def ping(target, verbose=True):
-        """ Check if the target can be pinged. Returns True if at least 1/4 pings was successful. """
+        """
+        Check if the target can be pinged. A cheap TCP probe is tried first, falling back to an ICMP ping
+        for targets that don't answer TCP. Returns True if at least 1/4 pings was successful.
+        """
         if target is None:
             return False
 
@@ -356,8 +412,9 @@ class VPNService(object):
         # If NTP date changes the time during a execution of a sub process this hangs forever.
         def popen_timeout(command, timeout):
             p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            for _ in xrange(timeout):
-                time.sleep(1)
+            # Poll in short steps (counted, not timed, to stay clear of clock changes) so a finished ping returns promptly
+            for _ in xrange(int(timeout / PING_POLL_INTERVAL)):
+                time.sleep(PING_POLL_INTERVAL)
                 if p.poll() is not None:
                     stdout_data, stderr_data = p.communicate()
                     if p.returncode == 0:
@@ -369,6 +426,8 @@ class VPNService(object):
 
         if verbose is True:
             logger.info("Testing ping to {0}".format(target))
+        if VPNService._tcp_probe(target):
+            return True
         try:
             # Ping returns status code 0 if at least 1 ping is successful
             return popen_timeout(["ping", "-c", "3", target], 10)
@@ -376,61 +435,121 @@ class VPNService(object):
             logger.error("Error during ping: {0}".format(ex))
             return False
 
+    @staticmethod
+    def _tcp_probe(target, port=443, timeout=1.0):
+        """ Check if the target answers a TCP connect. A refused connection also proves the target is reachable. """
+        try:
+            address_info = socket.getaddrinfo(target, port, 0, socket.SOCK_STREAM)
+        except socket.error:
+            return False
+        for family, socket_type, protocol, _, address in address_info:
+            try:
+                sock = socket.socket(family, socket_type, protocol)
+            except socket.error:
+                continue  # E.g. an IPv6 address on a gateway without IPv6 support
+            sock.settimeout(timeout)
+            try:
+                sock.connect(address)
+                return True
+            except socket.error as ex:
+                if ex.errno == errno.ECONNREFUSED:
+                    return True
+            finally:
+                sock.close()
+        return False
+
     @staticmethod
     def has_connectivity():
+        """ Checks the connectivity, reusing a recent result """
+        checked_at, result = VPNService._connectivity_cache
+        if checked_at is not None and 0 <= time.time() - checked_at < CONNECTIVITY_CACHE_TIME:
+            return result
+        result = VPNService._check_connectivity()
+        VPNService._connectivity_cache = (time.time(), result)
+        return result
+
+    @staticmethod
+    def _check_connectivity():
         # Check connectivity by using ping to recover from a messed up network stack on the BeagleBone
         # Prefer using OpenMotics infrastructure first
+        # All targets are pinged concurrently, the results are evaluated in order of preference
 
-        if VPNService.ping('cloud.openmotics.com'):
-            # OpenMotics infrastructure can be pinged
-            # > Connectivity
-            return True
-        can_ping_internet_by_fqdn = VPNService.ping('example.com') or VPNService.ping('google.com')
-        if can_ping_internet_by_fqdn:
-            # Public internet servers can be pinged by FQDN
-            # > Assume maintenance on OpenMotics infrastructure. Sufficient connectivity
-            return True
-        can_ping_internet_by_ip = VPNService.ping('8.8.8.8') or VPNService.ping('1.1.1.1')
-        if can_ping_internet_by_ip:
-            # Public internet servers can be pinged by IP, but not by FQDN
-            # > Assume DNS resolving issues. Insufficient connectivity
+        targets = ['cloud.openmotics.com', 'example.com', 'google.com', '8.8.8.8', '1.1.1.1', VPNService._get_gateway()]
+        pool = ThreadPool(len(targets))
+        try:
+            pings = dict((target, pool.apply_async(VPNService.ping, (target,))) for target in targets)
+
+            def can_ping(*_targets):
+                return any(pings[_target].get() for _target in _targets)
+
+            if can_ping('cloud.openmotics.com'):
+                # OpenMotics infrastructure can be pinged
+                # > Connectivity
+                return True
+            can_ping_internet_by_fqdn = can_ping('example.com', 'google.com')
+            if can_ping_internet_by_fqdn:
+                # Public internet servers can be pinged by FQDN
+                # > Assume maintenance on OpenMotics infrastructure. Sufficient connectivity
+                return True
+            can_ping_internet_by_ip = can_ping('8.8.8.8', '1.1.1.1')
+            if can_ping_internet_by_ip:
+                # Public internet servers can be pinged by IP, but not by FQDN
+                # > Assume DNS resolving issues. Insufficient connectivity
+                return False
+            # Public internet servers cannot be pinged by IP, nor by FQDN
+            can_ping_default_gateway = can_ping(targets[-1])
+            if can_ping_default_gateway:
+                # > Assume ISP outage. Sufficient connectivity
+                return True
+            # > Assume broken TCP stack. No connectivity
             return False
-        # Public internet servers cannot be pinged by IP, nor by FQDN
-        can_ping_default_gateway = VPNService.ping(VPNService._get_gateway())
-        if can_ping_default_gateway:
-            # > Assume ISP outage. Sufficient connectivity
-            return True
-        # > Assume broken TCP stack. No connectivity
-        return False
+        finally:
+            pool.close()  # Pings that are still running finish in the background
 
     def _get_debug_dumps(self):
         if not self._config_controller.get_setting('cloud_support', False):
             return {}
-        found_timestamps = []
-        for filename in glob.glob('/tmp/debug_*.json'):
-            timestamp = int(filename.replace('/tmp/debug_', '').replace('.json', ''))
-            if timestamp not in self._debug_data:
-                with open(filename, 'r') as debug_file:
+        found_timestamps = set()
+        for filename in os.listdir(DEBUG_DUMP_FOLDER):
+            if not (filename.startswith('debug_') and filename.endswith('.json')):
+                continue
+            try:
+                timestamp = int(filename[6:-5])
+            except ValueError:
+                continue
+            path = os.path.join(DEBUG_DUMP_FOLDER, filename)
+            mtime = os.stat(path).st_mtime
+            if timestamp not in self._debug_data or self._debug_mtimes.get(timestamp) != mtime:
+                with open(path, 'rb') as debug_file:
                     self._debug_data[timestamp] = json.load(debug_file)
-            found_timestamps.append(timestamp)
-        for timestamp in self._debug_data:
+                self._debug_mtimes[timestamp] = mtime
+            found_timestamps.add(timestamp)
+        for timestamp in list(self._debug_data):
             if timestamp not in found_timestamps:
                 del self._debug_data[timestamp]
+                self._debug_mtimes.pop(timestamp, None)
         return self._debug_data
 
     def _clean_debug_dumps(self):
-        for timestamp in self._debug_data:
-            filename = '/tmp/debug_{0}.json'.format(timestamp)
+        for timestamp in list(self._debug_data):
+            filename = os.path.join(DEBUG_DUMP_FOLDER, 'debug_{0}.json'.format(timestamp))
             try:
                 os.remove(filename)
             except Exception as ex:
                 logger.error('Could not remove debug file {0}: {1}'.format(filename, ex))
+                continue
+            # The dump has been delivered, so it doesn't need to be tracked anymore
+            del self._debug_data[timestamp]
+            self._debug_mtimes.pop(timestamp, None)
 
     @staticmethod
     def _get_gateway():
         """ Get the default gateway. """
         try:
-            return subprocess.check_output("ip r | grep '^default via' | awk '{ print $3; }'", shell=True)
+            for _, destination, gateway, mask in get_routes():
+                if destination == '0.0.0.0' and mask == '0.0.0.0' and gateway != '0.0.0.0':
+                    return gateway
+            return
         except Exception as ex:
             logger.error("Error during get_gateway: {0}".format(ex))
             return
@@ -445,16 +564,14 @@ class VPNService(object):
     def _event_receiver(self, event, payload):
         _ = payload
         if event == OMBusEvents.DIRTY_EEPROM:
-            self._eeprom_events.appendleft(True)
+            with self._eeprom_events_lock:
+                self._eeprom_events.appendleft(True)
 
     @staticmethod
-    def _unload_queue(queue):
-        events = []
-        try:
-            while True:
-                events.append(queue.pop())
-        except IndexError:
-            pass
+    def _unload_queue(queue, lock):
+        with lock:
+            events = list(reversed(queue))  # Oldest first
+            queue.clear()
         return events
 
     def _set_vpn(self, should_open):
@@ -466,7 +583,7 @@ class VPNService(object):
             logger.info("closing vpn")
             VpnController.stop_vpn()
         is_running = VpnController.check_vpn()
-        self._vpn_open = is_running and self._vpn_controller.vpn_connected
+        self._vpn_open = is_running and self._vpn_controller.is_tunnel_up()
         self._message_client.send_event(OMBusEvents.VPN_OPEN, self._vpn_open)
 
     def start(self):
@@ -474,9 +591,9 @@ class VPNService(object):
 
     def _check_vpn(self):
         while True:
-            self._last_cycle = time.time()
+            start_time = time.time()
+            self._last_cycle = start_time
             try:
-                start_time = time.time()
 
                 # Check whether connection to the Cloud is enabled/disabled
                 cloud_enabled = self._config_controller.get_setting('cloud_enabled')
@@ -492,14 +609,20 @@ class VPNService(object):
                 call_data = {'events': {}}
 
                 # Events  # TODO: Replace this by websocket events in the future
-                dirty_events = VPNService._unload_queue(self._eeprom_events)
+                dirty_events = VPNService._unload_queue(self._eeprom_events, self._eeprom_events_lock)
                 if dirty_events:
                     call_data['events']['DIRTY_EEPROM'] = True
 
                 # Collect data to be send to the Cloud
-                for collector_name in self._collectors:
-                    collector = self._collectors[collector_name]
-                    data = collector.collect()
+                pending = dict((collector_name, self._collector_pool.apply_async(collector.collect, (start_time,)))
+                               for collector_name, collector in self._collectors.iteritems()
+                               if collector.should_collect(start_time))
+                for collector_name, result in pending.iteritems():
+                    try:
+                        data = result.get(COLLECTOR_TIMEOUT)
+                    except TimeoutError:
+                        logger.warning('Timeout while collecting {0} data'.format(collector_name))
+                        continue
                     if data is not None:
                         call_data[collector_name] = data
                 call_data['debug'] = {'dumps': self._get_debug_dumps()}
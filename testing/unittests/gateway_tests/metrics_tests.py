@@ -97,6 +97,116 @@ class MetricsTest(unittest.TestCase):
         self.assertEqual(MetricsTest.intervals.get('energy'), 900)
         self.assertEqual(config_controller.get_setting('cloud_metrics_interval|energy'), 900)
 
+    def test_get_filter(self):
+        _, metrics_controller = MetricsTest._get_controller(intervals=[])
+        metrics_controller.definitions = {'OpenMotics': {'energy': {}, 'counter': {}},
+                                          'MBus': {'energy': {}}}
+        self.assertEqual(metrics_controller.get_filter('source', None), {'OpenMotics', 'MBus'})
+        self.assertEqual(metrics_controller.get_filter('source', 'Open.*'), {'OpenMotics'})
+        self.assertEqual(metrics_controller.get_filter('metric_type', 'energy'), {'energy'})
+        self.assertEqual(metrics_controller.get_filter('metric_type', 'e.*'), {'energy'})
+        self.assertEqual(metrics_controller.get_filter('source', 'e.*'), set())
+        # Identical patterns are compiled only once, regardless of the filter type
+        self.assertEqual(sorted(metrics_controller._compiled_filters.keys()), ['Open.*', 'e.*', 'energy'])
+
+    def test_set_plugin_definitions(self):
+        _, metrics_controller = MetricsTest._get_controller(intervals=[])
+        logs = []
+        metrics_controller._plugin_controller.get_logger = lambda plugin: logs.append
+        metric_definition = {'name': 'power', 'description': 'Power', 'type': 'gauge', 'unit': 'W'}
+        metrics_controller.set_plugin_definitions({'P1': [{'type': 'energy', 'tags': ['id'], 'metrics': [metric_definition]},
+                                                          {'type': 'broken', 'tags': ['id']},
+                                                          {'type': 'broken', 'tags': 'id', 'metrics': []}],
+                                                   'P2': [{'type': 'broken', 'tags': [], 'metrics': ['power']},
+                                                          {'type': 'broken', 'tags': [], 'metrics': [{'name': 'power'}]},
+                                                          {'type': 'broken', 'tags': [], 'metrics': [dict(metric_definition, unit=0)]}]})
+        self.assertEqual({'P1': {'energy': {'type': 'energy', 'tags': ['id'], 'metrics': [metric_definition]}}},
+                         metrics_controller.definitions)
+        self.assertEqual(sorted(['Definitions should contain keys: type, metrics, tags',
+                                 "Definitions key tags should be of type <type 'list'>",
+                                 'Metric definitions should be dictionaries',
+                                 'Metric definitions should contain keys: name, description, type, unit',
+                                 "Metric definitions key unit should be of type <type 'basestring'>"]), sorted(logs))
+
+    def test_validate_plugin_metric(self):
+        _, metrics_controller = MetricsTest._get_controller(intervals=[])
+        logs = []
+        metrics_controller._plugin_controller.get_logger = lambda plugin: logs.append
+        metrics_controller.set_plugin_definitions({'P1': [{'type': 'energy',
+                                                           'tags': ['id'],
+                                                           'metrics': [{'name': 'power', 'description': 'Power', 'type': 'gauge', 'unit': 'W'}]}]})
+
+        def validate(**kwargs):
+            metric = {'source': 'P1', 'type': 'energy', 'timestamp': 0, 'tags': {'id': 1}, 'values': {'power': 5}}
+            metric.update(kwargs)
+            del logs[:]
+            return metrics_controller._validate_plugin_metric(metric)
+
+        self.assertTrue(validate())
+        self.assertEqual([], logs)
+        self.assertFalse(validate(type='unknown'))
+        self.assertEqual([], logs)
+        self.assertFalse(validate(timestamp='0'))
+        self.assertEqual(["Metric key timestamp should be of type (<type 'float'>, <type 'int'>)"], logs)
+        self.assertFalse(validate(tags={}))
+        self.assertEqual(['Metric tag id should be defined'], logs)
+        self.assertFalse(validate(values={}))
+        self.assertEqual(['Metric should have at least one value'], logs)
+        self.assertFalse(validate(values={'power': 5, 'current': 1}))
+        self.assertEqual(['Metric contains unknown values: current'], logs)
+        # Definition removed while the metric was being validated
+        del metrics_controller._definition_value_names['P1']
+        self.assertFalse(validate())
+        self.assertEqual([], logs)
+
+    def test_get_cloud_identifier(self):
+        self.assertEqual((0, 'name'), MetricsController._get_cloud_identifier({'name': 'name', 'id': 0, 'other': 1}, ['id', 'name']))
+        self.assertEqual('id=0|name=[1, 2]', MetricsController._get_cloud_identifier({'name': [1, 2], 'id': 0}, ['id', 'name']))
+        self.assertEqual("id={'a': 1}", MetricsController._get_cloud_identifier({'id': {'a': 1}}, ['id']))
+
+    def test_distribute_openmotics(self):
+        _, metrics_controller = MetricsTest._get_controller(intervals=[])
+        received = []
+
+        def receiver(metric):
+            received.append(metric)
+            if len(received) == 6:
+                metrics_controller.stop()
+
+        metrics_controller.add_receiver(receiver)
+        metrics_controller.add_receiver(receiver)
+        metrics = [{'source': 'OpenMotics', 'type': 'energy', 'timestamp': 0, 'tags': {}, 'values': {'power': 0}},
+                   {'source': 'OpenMotics', 'type': 'energy', 'timestamp': 1, 'tags': {}, 'values': {'power': 1}},
+                   {'source': 'Plugin', 'type': 'Counter', 'timestamp': 1, 'tags': {}, 'values': {'count': 1}}]
+        for metric in metrics:
+            metrics_controller._put(metric)
+        metrics_controller._distribute_openmotics()
+        self.assertEqual([metrics[0], metrics[0], metrics[1], metrics[1], metrics[2], metrics[2]], received)
+        self.assertEqual({'total': 6, 'openmotics.energy': 4, 'plugin.counter': 2}, metrics_controller.outbound_rates)
+        self.assertEqual({'total': 3, 'openmotics.energy': 2, 'plugin.counter': 1}, metrics_controller.inbound_rates)
+        self.assertEqual({'total', 'openmotics.energy', 'plugin.counter'}, metrics_controller.rate_keys)
+        self.assertEqual(0, len(metrics_controller.metrics_queue_openmotics))
+
+    def test_distribute_plugins(self):
+        _, metrics_controller = MetricsTest._get_controller(intervals=[])
+        distributed = []
+
+        def distribute_metrics(metrics, rate_keys):
+            distributed.append((metrics, rate_keys))
+            metrics_controller.stop()
+            return {'total': 2, 'plugin.counter': 2}
+
+        metrics_controller._plugin_controller.distribute_metrics = distribute_metrics
+        metrics = [{'source': 'OpenMotics', 'type': 'energy', 'timestamp': 0, 'tags': {}, 'values': {'power': 0}},
+                   {'source': 'Plugin', 'type': 'Counter', 'timestamp': 1, 'tags': {}, 'values': {'count': 1}}]
+        for metric in metrics:
+            metrics_controller._put(metric)
+        metrics_controller._distribute_plugins()
+        # The rate keys calculated when queueing are passed along with the metrics
+        self.assertEqual([(metrics, ['openmotics.energy', 'plugin.counter'])], distributed)
+        self.assertEqual({'total': 2, 'plugin.counter': 2}, metrics_controller.outbound_rates)
+        self.assertEqual(0, len(metrics_controller.metrics_queue_plugins))
+
     def test_needs_upload(self):
         # 0. the boring stuff
         def get_setting(setting, fallback=None):
@@ -286,7 +396,7 @@ class MetricsTest(unittest.TestCase):
         self.assertDictEqual(metrics.pop(), metric_1)
 
         assert_fields(metrics_controller,
-                      cache={'OpenMotics': {'foobar': {'id=0|name=name': {'timestamp': 10}}}},
+                      cache={'OpenMotics': {'foobar': {(0, 'name'): {'timestamp': 10}}}},
                       queue=[[metric_1]],
                       stats={'queue': 1, 'buffer': 0, 'time_ago_send': 10, 'time_ago_try': 10},  # Nothing buffered yet
                       buffer=[],
@@ -308,7 +418,7 @@ class MetricsTest(unittest.TestCase):
         self.assertDictEqual(metrics.pop(), metric_1)
 
         assert_fields(metrics_controller,
-                      cache={'OpenMotics': {'foobar': {'id=0|name=name': {'timestamp': 20}}}},
+                      cache={'OpenMotics': {'foobar': {(0, 'name'): {'timestamp': 20}}}},
                       queue=[[metric_1], [metric_2]],
                       stats={'queue': 2, 'buffer': 1, 'time_ago_send': 21, 'time_ago_try': 11},
                       buffer=[],
@@ -331,7 +441,7 @@ class MetricsTest(unittest.TestCase):
         self.assertDictEqual(metrics.pop(), metric_1)
 
         assert_fields(metrics_controller,
-                      cache={'OpenMotics': {'foobar': {'id=0|name=name': {'timestamp': 30}}}},
+                      cache={'OpenMotics': {'foobar': {(0, 'name'): {'timestamp': 30}}}},
                       queue=[],
                       stats={'queue': 3, 'buffer': 1, 'time_ago_send': 32, 'time_ago_try': 11},  # Buffer stats not cleared yet
                       buffer=[],
@@ -357,7 +467,7 @@ class MetricsTest(unittest.TestCase):
         self.assertEqual(len(send_metrics), 0)  # No metric send, still < batch size
 
         assert_fields(metrics_controller,
-                      cache={'OpenMotics': {'foobar': {'id=0|name=name': {'timestamp': 50}}}},
+                      cache={'OpenMotics': {'foobar': {(0, 'name'): {'timestamp': 50}}}},
                       queue=[[metric_1], [metric_2]],
                       stats={'queue': 2, 'buffer': 0, 'time_ago_send': 21, 'time_ago_try': 21},
                       buffer=[],
@@ -379,7 +489,7 @@ class MetricsTest(unittest.TestCase):
         self.assertEqual(len(metrics), 0)
 
         assert_fields(metrics_controller,
-                      cache={'OpenMotics': {'foobar': {'id=0|name=name': {'timestamp': 60}}}},
+                      cache={'OpenMotics': {'foobar': {(0, 'name'): {'timestamp': 60}}}},
                       queue=[],
                       stats={'queue': 3, 'buffer': 0, 'time_ago_send': 31, 'time_ago_try': 31},
                       buffer=[],
@@ -399,7 +509,7 @@ class MetricsTest(unittest.TestCase):
         self.assertListEqual(metrics, [metric_1])
 
         assert_fields(metrics_controller,
-                      cache={'OpenMotics': {'foobar': {'id=0|name=name': {'timestamp': 360}}}},
+                      cache={'OpenMotics': {'foobar': {(0, 'name'): {'timestamp': 360}}}},
                       queue=[],
                       stats={'queue': 1, 'buffer': 0, 'time_ago_send': 301, 'time_ago_try': 301},
                       buffer=[],
@@ -424,7 +534,7 @@ class MetricsTest(unittest.TestCase):
         self.assertDictEqual(metrics.pop(), metric_1)
 
         assert_fields(metrics_controller,
-                      cache={'OpenMotics': {'foobar': {'id=0|name=name': {'timestamp': 375}}}},
+                      cache={'OpenMotics': {'foobar': {(0, 'name'): {'timestamp': 375}}}},
                       queue=[[metric_1]],
                       stats={'queue': 1, 'buffer': 0, 'time_ago_send': 11, 'time_ago_try': 11},  # Nothing buffered yet
                       buffer=[],
@@ -464,7 +574,7 @@ class MetricsTest(unittest.TestCase):
         self.assertDictEqual(metrics.pop(), metric_1)
 
         assert_fields(metrics_controller,
-                      cache={'OpenMotics': {'foobar': {'id=0|name=name': {'timestamp': 385}}}},
+                      cache={'OpenMotics': {'foobar': {(0, 'name'): {'timestamp': 385}}}},
                       queue=[],
                       stats={'queue': 1, 'buffer': 1, 'time_ago_send': 10, 'time_ago_try': 10},
                       buffer=[],
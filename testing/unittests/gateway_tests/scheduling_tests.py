@@ -62,8 +62,9 @@ class SchedulingControllerTest(unittest.TestCase):
 
     def tearDown(self):
         GatewayApi.RETURN_DATA = {}
-        if os.path.exists(self._db):
-            os.remove(self._db)
+        for filename in [self._db, '{0}-wal'.format(self._db), '{0}-shm'.format(self._db)]:
+            if os.path.exists(filename):
+                os.remove(filename)
 
     def _get_controller(self):
         SetUpTestInjections(scheduling_db=self._db,
@@ -121,6 +122,7 @@ class SchedulingControllerTest(unittest.TestCase):
         self.assertEquals(len(controller.schedules), 1)
         self.assertEquals(controller.schedules[0].name, 'group_action')
         self.assertEquals(controller.schedules[0].status, 'COMPLETED')
+        self.assertEquals(controller._active_schedules, {})
         controller.stop()
 
     def test_basic_action(self):
@@ -195,6 +197,25 @@ class SchedulingControllerTest(unittest.TestCase):
         self.assertEquals(controller.schedules[0].status, 'COMPLETED')
         controller.stop()
 
+    def test_repeating_action(self):
+        start = time.time()
+        semaphore = Semaphore(0)
+        controller = self._get_controller()
+        controller.set_unittest_semaphore(semaphore)
+        controller.add_schedule('repeating_action', start, 'GROUP_ACTION', 2, '* * * * *', None, None)
+        self.assertEquals(len(controller.schedules), 1)
+        next_execution = controller.schedules[0].next_execution
+        self.assertTrue(next_execution > start)
+        self.assertEquals(next_execution % 60, 0)
+        controller.start()
+        semaphore.acquire()
+        self.assertEquals(GatewayApi.RETURN_DATA['do_group_action'], 2)
+        self.assertEquals(controller.schedules[0].status, 'ACTIVE')
+        self.assertTrue(controller.schedules[0].last_executed >= next_execution)
+        semaphore.acquire()  # Executed again on the next minute mark
+        controller.stop()
+        self.assertTrue(controller.schedules[0].next_execution >= next_execution + 120)
+
     def test_two_actions(self):
         start = time.time()
         controller = self._get_controller()
@@ -207,6 +228,7 @@ class SchedulingControllerTest(unittest.TestCase):
                 controller.remove_schedule(s.id)
         self.assertEquals(len(controller.schedules), 1)
         self.assertEquals(controller.schedules[0].name, 'basic_action')
+        self.assertEquals([s.name for s in controller._active_schedules.values()], ['basic_action'])
 
 
 if __name__ == "__main__":
@@ -161,6 +161,45 @@ class UCANCommunicatorTest(unittest.TestCase):
                                   identifier=AddressField('ucan_address', 3))
         ucan_communicator.do_command(cc_address, command, ucan_address, {}, timeout=None)
 
+    def test_consumer_dispatching(self):
+        core_communicator = Mock()
+        ucan_communicator = UCANCommunicator(master_communicator=core_communicator, verbose=True)
+        cc_address = '000.000.000.000'
+        ucan_address = '001.002.003'
+
+        command = UCANCommandSpec(sid=SID.NORMAL_COMMAND,
+                                  instruction=Instruction(instruction=[0, 0]),
+                                  identifier=AddressField('ucan_address', 3),
+                                  response_instructions=[Instruction(instruction=[0, 1], checksum_byte=7)],
+                                  response_fields=[ByteArrayField('foo', 2)])
+        ucan_communicator.do_command(cc_address, command, ucan_address, {}, timeout=None)
+        consumer = ucan_communicator._consumers[cc_address][0]
+
+        # A payload for another uCAN is not delivered
+        payload = [0, 1, 3, 2, 1, 10, 20]
+        ucan_communicator._process_transport_message({'cc_address': cc_address,
+                                                      'nr_can_bytes': 8,
+                                                      'sid': 5,
+                                                      'payload': payload + [UCANCommandSpec.calculate_crc(payload)]})
+        self.assertEqual(ucan_communicator._consumers[cc_address], [consumer])
+
+        payload = [0, 1, 1, 2, 3, 10, 20]
+        ucan_communicator._process_transport_message({'cc_address': cc_address,
+                                                      'nr_can_bytes': 8,
+                                                      'sid': 5,
+                                                      'payload': payload + [UCANCommandSpec.calculate_crc(payload)]})
+        self.assertDictEqual(consumer.get(1), {'foo': [10, 20]})
+        self.assertEqual(ucan_communicator._consumers[cc_address], [])
+        self.assertEqual(ucan_communicator._consumers_by_hash[cc_address], {command.header_length: {}})
+
+        # Send-only commands are not kept around, as they will never receive a payload
+        command = UCANCommandSpec(sid=SID.NORMAL_COMMAND,
+                                  instruction=Instruction(instruction=[0, 2]),
+                                  identifier=AddressField('ucan_address', 3))
+        for _ in xrange(3):
+            ucan_communicator.do_command(cc_address, command, ucan_address, {}, timeout=None)
+        self.assertEqual(ucan_communicator._consumers[cc_address], [])
+
     def test_crc(self):
         payload = [10, 50, 250]
         total_payload = payload + Int32Field.encode_bytes(UCANPalletCommandSpec.calculate_crc(payload))
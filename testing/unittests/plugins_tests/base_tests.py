@@ -84,6 +84,7 @@ class PluginControllerTest(unittest.TestCase):
                                       plugins_path=PluginControllerTest.PLUGINS_PATH,
                                       plugin_config_path=PluginControllerTest.PLUGIN_CONFIG_PATH)
         metric_controller = type('MetricController', (), {'get_filter': lambda *args, **kwargs: ['test'],
+                                                          'get_rate_key': lambda _self, source, metric_type: '{0}.{1}'.format(source.lower(), metric_type.lower()),
                                                           'set_plugin_definitions': lambda _self, *args, **kwargs: None})()
         controller.set_metrics_controller(metric_controller)
         return controller
@@ -0,0 +1,110 @@
+# Copyright (C) 2019 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the power bootloader HexReader.
+"""
+
+import unittest
+import xmlrunner
+import os
+import intelhex
+from power_bootloader import HexReader
+
+
+class HexReaderTest(unittest.TestCase):
+    """ Tests for HexReader class """
+
+    FILE = 'test_power_bootloader.hex'
+    HOLE = (1000, 1100)  # Not in the hex file, should be padded with 0xFF
+
+    def tearDown(self):
+        if os.path.exists(HexReaderTest.FILE):
+            os.remove(HexReaderTest.FILE)
+
+    @staticmethod
+    def _value(address, offset):
+        if HexReaderTest.HOLE[0] <= address - offset < HexReaderTest.HOLE[1]:
+            return 255
+        return address % 251
+
+    @staticmethod
+    def _write_hex(start, end):
+        hex_file = intelhex.IntelHex()
+        for address in xrange(start, end):
+            if not HexReaderTest.HOLE[0] <= address - start < HexReaderTest.HOLE[1]:
+                hex_file[address] = address % 251
+        hex_file.tofile(HexReaderTest.FILE, format='hex')
+
+    def test_version_8(self):
+        HexReaderTest._write_hex(0, 2 * 44032)
+        reader = HexReader(HexReaderTest.FILE)
+
+        def expected_data(address):
+            # Three out of every four bytes, the fourth being a phantom byte
+            return [HexReaderTest._value(2 * address + 4 * i + j, 0) for i in xrange(64) for j in xrange(3)]
+
+        crc = 0
+        blocks = {}
+        for address in range(0, 1024, 128) + range(8192, 44032, 128):
+            data = reader.get_bytes_version_8(address)
+            self.assertEqual(195, len(data))
+            blocks[address] = list(data)
+            if address != 43904:
+                crc += sum(data[3:])
+
+        vector_data = expected_data(0)
+        vector_data[1] = 4  # Start address of the bootloader
+        self.assertEqual([0, 0, 0] + vector_data, blocks[0])
+        self.assertEqual([0, 32, 0] + expected_data(8192), blocks[8192])
+
+        tail_data = expected_data(43904)
+        crc += sum(tail_data[:-6])
+        self.assertEqual(crc, reader.get_crc())
+        tail_data[-4:] = [(crc >> 24) & 255, (crc >> 16) & 255, (crc >> 8) & 255, crc & 255]
+        self.assertEqual([128, 171, 0] + tail_data, blocks[43904])
+
+    def test_version_12(self):
+        start = 0x1D006000
+        HexReaderTest._write_hex(start, 0x1D040000)
+        reader = HexReader(HexReaderTest.FILE)
+
+        def expected_data(address):
+            return [HexReaderTest._value(address + i, start) for i in xrange(128)]
+
+        crc = 0
+        blocks = {}
+        for address in range(start, 0x1D03FFFB, 128):
+            data = reader.get_bytes_version_12(address)
+            self.assertEqual(132, len(data))
+            blocks[address] = list(data)
+            if address != 486801280:
+                crc += sum(data[4:])
+
+        self.assertEqual([0x00, 0x60, 0x00, 0x1D] + expected_data(start), blocks[start])
+        self.assertEqual([0x80, 0x63, 0x00, 0x1D] + expected_data(start + 896), blocks[start + 896])  # Contains the hole
+
+        tail_data = expected_data(486801280)
+        crc += sum(tail_data[:-4])
+        self.assertEqual(crc, reader.get_crc())
+        tail_data[-4:] = [crc & 255, (crc >> 8) & 255, (crc >> 16) & 255, (crc >> 24) & 255]
+        self.assertEqual([0x80, 0xFF, 0x03, 0x1D] + tail_data, blocks[486801280])
+
+    def test_int_to_array_12(self):
+        self.assertEqual([0x80, 0xFF, 0x03, 0x1D], HexReader.int_to_array_12(486801280))
+        self.assertEqual([1, 0, 0, 0], HexReader.int_to_array_12(1))
+
+
+if __name__ == "__main__":
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='../gw-unit-reports'))
@@ -40,6 +40,9 @@ python2 power_tests/power_communicator_tests.py
 echo "Running time keeper tests"
 python2 power_tests/time_keeper_tests.py
 
+echo "Running power bootloader tests"
+python2 power_tests/power_bootloader_tests.py
+
 echo "Running plugin base tests"
 python2 plugins_tests/base_tests.py
 
@@ -53,3 +56,6 @@ python2 -m master_core_tests.ucan_communicator_tests
 
 echo "Running metrics tests"
 python2 gateway_tests/metrics_tests.py
+
+echo "Running vpn service tests"
+python2 vpn_service_tests.py
@@ -23,8 +23,16 @@ import threading
 import unittest
 import xmlrunner
 import os
+import tempfile
+import shutil
+import socket
+from mock import Mock
 
-from vpn_service import BufferingDataCollector
+import vpn_service
+from vpn_service import DataCollector, VpnController, VPNService, get_routes
+
+# The BufferingDataCollector no longer exists in the vpn_service, its tests are kept for reference
+BufferingDataCollector = getattr(vpn_service, 'BufferingDataCollector', None)
 
 import constants
 constants.get_buffer_file = lambda filename: "/tmp/%s.buffer" % filename
@@ -51,6 +59,7 @@ def gen():
     return get_data
 
 
+@unittest.skipIf(BufferingDataCollector is None, 'BufferingDataCollector is not available')
 class BufferingDataCollectorTest(unittest.TestCase):
     """ Tests for BufferingDataCollector class """
 
@@ -173,5 +182,187 @@ class BufferingDataCollectorTest(unittest.TestCase):
         f.close()
 
 
+ROUTES = """Iface\tDestination\tGateway \tFlags\tRefCnt\tUse\tMetric\tMask\t\tMTU\tWindow\tIRTT
+eth0\t00000000\t0100A8C0\t0003\t0\t0\t0\t00000000\t0\t0\t0
+eth0\t0000A8C0\t00000000\t0001\t0\t0\t0\t00FFFFFF\t0\t0\t0
+tun0\t0100250A\t0500250A\t0007\t0\t0\t0\tFFFFFFFF\t0\t0\t0
+tun0\t0500250A\t00000000\t0005\t0\t0\t0\tFFFFFFFF\t0\t0\t0
+tun0\t0000250A\t0500250A\t0003\t0\t0\t0\t0000FFFF\t0\t0\t0
+"""
+
+
+class RoutesTest(unittest.TestCase):
+    """ Tests for the routing table parsing and the filters using it """
+
+    def setUp(self):
+        self._folder = tempfile.mkdtemp()
+        self._route_file = os.path.join(self._folder, 'route')
+        with open(self._route_file, 'w') as route_file:
+            route_file.write(ROUTES)
+        self._get_routes = vpn_service.get_routes
+        vpn_service.get_routes = lambda: get_routes(self._route_file)
+        self._ping = VPNService.__dict__['ping']
+
+    def tearDown(self):
+        vpn_service.get_routes = self._get_routes
+        VPNService.ping = self._ping
+        shutil.rmtree(self._folder)
+
+    def test_get_routes(self):
+        """ Test parsing the hex encoded, little endian addresses """
+        self.assertEqual([('eth0', '0.0.0.0', '192.168.0.1', '0.0.0.0'),
+                          ('eth0', '192.168.0.0', '0.0.0.0', '255.255.255.0'),
+                          ('tun0', '10.37.0.1', '10.37.0.5', '255.255.255.255'),
+                          ('tun0', '10.37.0.5', '0.0.0.0', '255.255.255.255'),
+                          ('tun0', '10.37.0.0', '10.37.0.5', '255.255.0.0')],
+                         get_routes(self._route_file))
+
+    def test_get_gateway(self):
+        """ Test getting the gateway of the default route """
+        self.assertEqual('192.168.0.1', VPNService._get_gateway())
+        with open(self._route_file, 'w') as route_file:
+            route_file.write(''.join(line + '\n' for line in ROUTES.splitlines() if not line.startswith('eth0\t00000000')))
+        self.assertIsNone(VPNService._get_gateway())
+
+    def test_is_tunnel_up(self):
+        """ Test that only the tun host routes with a gateway are pinged as VPN servers """
+        VPNService.ping = staticmethod(Mock(return_value=False))
+        self.assertFalse(VpnController().is_tunnel_up())
+        self.assertEqual([(('10.37.0.1',), {'verbose': False})], VPNService.ping.call_args_list)
+
+        VPNService.ping = staticmethod(Mock(return_value=True))
+        self.assertTrue(VpnController().is_tunnel_up())
+
+
+class TcpProbeTest(unittest.TestCase):
+    """ Tests for the TCP probe used by the ping """
+
+    def setUp(self):
+        self._getaddrinfo = socket.getaddrinfo
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(1)
+
+    def tearDown(self):
+        socket.getaddrinfo = self._getaddrinfo
+        self._server.close()
+
+    def test_unsupported_family(self):
+        """ Test that an address family the kernel can't open is skipped instead of raised """
+        unsupported = (-1, socket.SOCK_STREAM, 0, '', ('::1', 443))
+        supported = (socket.AF_INET, socket.SOCK_STREAM, 0, '', self._server.getsockname())
+        socket.getaddrinfo = lambda *args: [unsupported]
+        self.assertFalse(VPNService._tcp_probe('localhost'))
+        socket.getaddrinfo = lambda *args: [unsupported, supported]
+        self.assertTrue(VPNService._tcp_probe('localhost'))
+
+
+class TimerTest(unittest.TestCase):
+    """ Tests for the periodic checks, including a clock that jumped backwards """
+
+    def setUp(self):
+        self._time = time.time
+        self._systemctl = VpnController.__dict__['_systemctl']
+        self._get_routes = vpn_service.get_routes
+
+    def tearDown(self):
+        time.time = self._time
+        VpnController._systemctl = self._systemctl
+        VpnController._last_known_state = None
+        VpnController._last_checked = 0
+        vpn_service.get_routes = self._get_routes
+
+    def test_should_collect(self):
+        """ Test the collector being due, not due, and last collected in the future """
+        collector = DataCollector(lambda: 'data', 60)
+        self.assertEqual('data', collector.collect(1000))
+        self.assertFalse(collector.should_collect(1059))
+        self.assertIsNone(collector.collect(1059))
+        self.assertTrue(collector.should_collect(1060))
+        self.assertTrue(collector.should_collect(999))  # Clock jumped backwards
+        self.assertEqual('data', collector.collect(999))
+        self.assertFalse(collector.should_collect(1000))
+        self.assertTrue(DataCollector(lambda: 'data').should_collect(0))
+
+    def test_check_vpn(self):
+        """ Test the cached openvpn state being due, not due, and checked in the future """
+        VpnController._systemctl = staticmethod(Mock(return_value=True))
+        time.time = lambda: 1000.0
+        self.assertTrue(VpnController.check_vpn())
+        self.assertEqual(1, VpnController._systemctl.call_count)
+        time.time = lambda: 1029.0
+        self.assertTrue(VpnController.check_vpn())
+        self.assertEqual(1, VpnController._systemctl.call_count)
+        time.time = lambda: 1030.0
+        self.assertTrue(VpnController.check_vpn())
+        self.assertEqual(2, VpnController._systemctl.call_count)
+        time.time = lambda: 999.0  # Clock jumped backwards
+        self.assertTrue(VpnController.check_vpn())
+        self.assertEqual(3, VpnController._systemctl.call_count)
+
+    def test_is_tunnel_up(self):
+        """ Test the cached tunnel state being due, not due, and checked in the future """
+        get_routes_mock = Mock(return_value=[])
+        vpn_service.get_routes = get_routes_mock
+        controller = VpnController()
+        time.time = lambda: 1000.0
+        self.assertFalse(controller.is_tunnel_up())
+        self.assertEqual(1, get_routes_mock.call_count)
+        time.time = lambda: 1029.0
+        self.assertFalse(controller.is_tunnel_up())
+        self.assertEqual(1, get_routes_mock.call_count)
+        time.time = lambda: 1030.0
+        self.assertFalse(controller.is_tunnel_up())
+        self.assertEqual(2, get_routes_mock.call_count)
+        time.time = lambda: 999.0  # Clock jumped backwards
+        self.assertFalse(controller.is_tunnel_up())
+        self.assertEqual(3, get_routes_mock.call_count)
+
+
+class DebugDumpsTest(unittest.TestCase):
+    """ Tests for the debug dump caching """
+
+    def setUp(self):
+        self._folder = tempfile.mkdtemp()
+        self._debug_dump_folder = vpn_service.DEBUG_DUMP_FOLDER
+        vpn_service.DEBUG_DUMP_FOLDER = self._folder
+        # The debug dumps only need the configuration, so the service isn't fully initialized
+        self._service = VPNService.__new__(VPNService)
+        self._service._config_controller = Mock(get_setting=Mock(return_value=True))
+        self._service._debug_data = {}
+        self._service._debug_mtimes = {}
+
+    def tearDown(self):
+        vpn_service.DEBUG_DUMP_FOLDER = self._debug_dump_folder
+        shutil.rmtree(self._folder)
+
+    def _write_dump(self, timestamp, data, mtime):
+        path = os.path.join(self._folder, 'debug_{0}.json'.format(timestamp))
+        with open(path, 'w') as debug_file:
+            debug_file.write(data)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_get_debug_dumps(self):
+        """ Test that only new or modified dumps are parsed, and that removed dumps are dropped """
+        self._write_dump(1, '{"a": 1}', 1000)
+        path = self._write_dump(2, '{"b": 2}', 1000)
+        self._write_dump('x', '{}', 1000)  # Not a debug dump
+        self.assertEqual({1: {'a': 1}, 2: {'b': 2}}, self._service._get_debug_dumps())
+
+        # Unchanged mtime, so the (altered) content isn't parsed again
+        self._write_dump(1, '{"a": 10}', 1000)
+        self.assertEqual({1: {'a': 1}, 2: {'b': 2}}, self._service._get_debug_dumps())
+
+        # Modified
+        self._write_dump(1, '{"a": 10}', 1001)
+        self.assertEqual({1: {'a': 10}, 2: {'b': 2}}, self._service._get_debug_dumps())
+
+        # Removed
+        os.remove(path)
+        self.assertEqual({1: {'a': 10}}, self._service._get_debug_dumps())
+        self.assertEqual([1], self._service._debug_mtimes.keys())
+
+
 if __name__ == "__main__":
     unittest.main(testRunner=xmlrunner.XMLTestRunner(output='gw-unit-reports'))